@@ -1,18 +1,23 @@
+from timing import IMPORT_START, timed, format_timing_report
 from ipywidgets import (Label, Checkbox, Output, VBox, HBox,
                         ToggleButtons, IntSlider, Tab, Layout, Button,
                         Accordion, HTML, Dropdown, GridspecLayout)
 import IPython.display
+import asyncio
+from functools import partial
 import pathlib
+import time
+import traceback
 from matplotlib.backend_bases import MouseButton
 import nibabel as nib
 import numpy as np
-import xarray as xr
 
 from slice import create_slice_fig, plot_slice, get_axis_names_from_slice
-from evoked_field import (create_topomap_fig, plot_sensors, plot_evoked,
-                          reset_topomaps)
+from evoked_field import (create_topomap_fig, create_topomap_renderers,
+                          plot_sensors, render_evoked_field, reset_topomaps,
+                          rescale_topomaps)
 from cursor import enable_crosshair_cursor
-from transforms import gen_ras_to_head_trans
+from overlay import init_overlays, redraw_overlays
 from callbacks import (handle_click_in_slice_browser_mode,
                        handle_click_in_set_dipole_pos_mode,
                        handle_click_in_set_dipole_ori_mode)
@@ -21,7 +26,12 @@ from dipole import (plot_dipole_pos_marker, plot_dipole_ori_marker,
                     remove_dipole_pos_markers, remove_dipole_ori_markers,
                     update_dipole_ori, update_dipole_pos,
                     draw_dipole_if_necessary)
-from forward import load_fwd_lookup_table
+from mri import load_mr_volume, create_mr_pyramid
+from simulator import Simulator
+from evaluation import AsyncEvaluator
+from download import GITHUB_DATA_URL
+
+_IMPORT_TIME = time.perf_counter() - IMPORT_START
 
 
 # This widget will capture the MNE output.
@@ -36,38 +46,72 @@ class App:
                  trans=None,
                  t1_img=None,
                  subject='sample',
-                 data_path='data'):
+                 data_path='data',
+                 leadfield_cache_size=128,
+                 cache_mr_image=True,
+                 slice_pyramid_levels=3,
+                 defer_full_res_slices=False,
+                 leadfield_interpolation='nearest',
+                 data_url=GITHUB_DATA_URL,
+                 prefetch_radius=1,
+                 prefetch_workers=4,
+                 async_evaluation=True,
+                 progressive_startup=True,
+                 report_startup=False,
+                 simulator=None):
+        self._startup_times = dict(imports=_IMPORT_TIME)
+        self._report_startup = report_startup
+        times = self._startup_times
+
         self._evoked = evoked
         self._info = evoked.info if info is None else info
         self._trans = trans
 
-        img, img_canonical, data_canonical_mm = self._init_mr_image(t1_img)
-        self._t1_img = img
-        self._t1_img_canonical = img_canonical
-        self._t1_img_canonical_data = data_canonical_mm
-        del img, img_canonical, data_canonical_mm
-
         self._subject = subject
         self._data_path = (pathlib.Path('data') if data_path is None
                            else pathlib.Path(data_path))
-        self._fwd_path = self._data_path / 'fwd'
         self._subjects_dir = self._data_path / 'subjects'
-        self._bem_path = self._data_path / f'{subject}-bem-sol.fif'
 
-        self._fwd_lookup_table = load_fwd_lookup_table(fwd_path=self._fwd_path)
-
-        self._exact_solution = False
+        self._t1_img = t1_img
+        with timed(times, 'MR image'):
+            self._t1_img_canonical_data = self._init_mr_image(
+                t1_img, cache=cache_mr_image, n_levels=slice_pyramid_levels)
+        self._defer_full_res_slices = defer_full_res_slices
+
+        # A simulator may be passed in, e.g. a server.SimulatorClient to
+        # share the leadfields with other sessions. It's already configured,
+        # so we refuse to (silently) ignore the options it would take.
+        if simulator is not None:
+            simulator_options = dict(
+                leadfield_cache_size=(leadfield_cache_size, 128),
+                leadfield_interpolation=(leadfield_interpolation, 'nearest'),
+                data_url=(data_url, GITHUB_DATA_URL),
+                prefetch_radius=(prefetch_radius, 1),
+                prefetch_workers=(prefetch_workers, 4))
+            for name, (value, default) in simulator_options.items():
+                if value != default:
+                    raise ValueError(f'{name} cannot be set if a simulator '
+                                     f'is passed; configure the simulator '
+                                     f'instead')
+
+        with timed(times, 'simulator'):
+            if simulator is None:
+                simulator = Simulator(
+                    info=self._info, trans=self._trans, t1_img=self._t1_img,
+                    subject=subject, data_path=self._data_path,
+                    interpolation=leadfield_interpolation,
+                    leadfield_cache_size=leadfield_cache_size,
+                    data_url=data_url, prefetch_radius=prefetch_radius,
+                    prefetch_workers=prefetch_workers)
+            self._simulator = simulator
+        self._geometry = self._simulator.geometry
+
+        self._evaluator = AsyncEvaluator() if async_evaluation else None
         self._state = self._init_state()
-        self._widget = self._init_widget()
+        with timed(times, 'widgets'):
+            self._widget = self._init_widget()
         self._markers = self._init_markers()
 
-        self._plot_slice(axis='all')
-
-        self._plot_sensors()
-
-        self._ras_to_head_t = gen_ras_to_head_trans(head_to_mri_t=self._trans,
-                                                    t1_img=self._t1_img)
-
         self._preset_coords = {
             'Preset 1': dict(pos=[2.94, -76.54, -0.38],
                              ori=[1., 1., 1.]),
@@ -76,25 +120,68 @@ class App:
             'Preset 3': dict(pos=[21.60, 80.03, 34.01],
                              ori=[1., 0., 0.])}
 
-        self._gen_app_layout()
+        with timed(times, 'layout'):
+            self._gen_app_layout()
         self._enable_crosshair_cursor()
 
-    @staticmethod
-    def _init_mr_image(img):
-        img_canonical = nib.as_closest_canonical(img)
-        vox_grid = np.c_[np.arange(img_canonical.dataobj.shape[0]),
-                         np.arange(img_canonical.dataobj.shape[1]),
-                         np.arange(img_canonical.dataobj.shape[2])]
-
-        coords_mm = nib.affines.apply_affine(img_canonical.affine,
-                                             pts=vox_grid)
-        data_canonical_mm = xr.DataArray(data=img_canonical.dataobj,
-                                         dims=('x', 'y', 'z'),
-                                         coords=(coords_mm[:, 0],
-                                                 coords_mm[:, 1],
-                                                 coords_mm[:, 2]))
+        # Filling the figures takes a while, so we show the layout first and
+        # fill them one by one afterwards, see display().
+        self._startup_steps = self._gen_startup_steps()
+        self._startup_scheduled = False
+        self._update_updating_label()
+        if not progressive_startup:
+            while self._startup_steps:
+                self._run_startup_step()
+
+    def _gen_startup_steps(self):
+        steps = [(f'slice {axis}', partial(self._plot_slice, axis=axis))
+                 for axis in ('x', 'y', 'z')]
+        steps += [(f'sensors {ch_type}',
+                   partial(self._plot_sensors, ch_type=ch_type))
+                  for ch_type in ('mag', 'grad', 'eeg')]
+        steps.append(('topomap renderers', self._init_topomap_renderers))
+        return steps
+
+    def _run_startup_step(self):
+        name, step = self._startup_steps.pop(0)
+        try:
+            with timed(self._startup_times, name):
+                step()
+        finally:
+            if not self._startup_steps:
+                self._update_updating_label()
+                if self._report_startup:
+                    with output_widget:
+                        self.print_startup_report()
+
+    def _run_startup_steps_in_loop(self, loop):
+        # Yield to the event loop after each step, so the frontend can show
+        # the figures (and the kernel can handle events) in the meantime.
+        try:
+            self._run_startup_step()
+        except Exception:
+            # asyncio would merely log the error, and stop here. Show it,
+            # and carry on with the remaining steps.
+            with output_widget:
+                traceback.print_exc()
+        if self._startup_steps:
+            loop.call_soon(self._run_startup_steps_in_loop, loop)
+
+    def print_startup_report(self):
+        """Print how long each phase of the startup took.
+        """
+        print(format_timing_report(self._startup_times))
+
+    def _init_mr_image(self, img, cache, n_levels):
+        if cache:
+            cache_fname = (self._subjects_dir / self._subject / 'mri' /
+                           'T1-canonical.npy')
+        else:
+            cache_fname = None
 
-        return img, img_canonical, data_canonical_mm
+        volume = load_mr_volume(img, cache_fname=cache_fname)
+        pyramid = create_mr_pyramid(volume, n_levels=n_levels)
+        return pyramid
 
     def _init_state(self):
         state = dict()
@@ -105,6 +192,7 @@ class App:
         state['dipole_pos'] = dict(x=None, y=None, z=None)
         state['dipole_ori'] = dict(x=None, y=None, z=None)
         state['dipole_amplitude'] = 50e-9  # Am
+        state['topomap_amplitude'] = None  # Amplitude currently displayed
         state['label_text'] = dict(
             x=(f'sagittal (x = {round(state["slice_coord"]["x"]["val"])} mm)'),
             y=(f'coronal (y = {round(state["slice_coord"]["y"]["val"])} mm)'),
@@ -117,8 +205,23 @@ class App:
         state['updating'] = False
         return state
 
+    def _init_topomap_renderers(self):
+        if self._widget['topomap_renderer'] is None:
+            self._widget['topomap_renderer'] = create_topomap_renderers(
+                info=self._info)
+
+    @output_widget.capture(clear_output=True)
     def _toggle_exact_solution(self, change):
-        self._exact_solution = not self._exact_solution
+        simulator = self._simulator
+        simulator.exact_solution = not simulator.exact_solution
+
+        state = self._state
+        if (state['dipole_pos']['x'] is not None and
+                state['dipole_ori']['x'] is not None and
+                state['dipole_pos'] != state['dipole_ori']):
+            self._toggle_updating_state()
+            self._plot_evoked()
+            self._toggle_updating_state()
 
     def _init_widget(self):
         state = self._state
@@ -127,11 +230,14 @@ class App:
                    y=self._create_slice_fig(),
                    z=self._create_slice_fig())
         widget['fig'] = fig
+        widget['slice_timer'] = dict(x=None, y=None, z=None)
+        widget['slice_defer_full_res'] = self._defer_full_res_slices
 
         topomap_fig = dict(mag=create_topomap_fig(),
                            grad=create_topomap_fig(),
                            eeg=create_topomap_fig())
         widget['topomap_fig'] = topomap_fig
+        widget['topomap_renderer'] = None  # Created during startup.
 
         label = dict()
         label['axis'] = dict(x=HTML(f"<b>{state['label_text']['x']}</b>"),
@@ -166,16 +272,17 @@ class App:
         widget['reset_button'].on_click(self._handle_reset_button_click)
 
         checkbox = dict(exact_solution=Checkbox(
-            value=self._exact_solution,
-            description='Exact solution (slow!)',
-            tooltip='Calculate an exact forward projection. This is SLOW!'))
+            value=self._simulator.exact_solution,
+            description='Exact solution',
+            tooltip='Calculate an exact forward projection instead of using '
+                    'pre-calculated solutions.'))
         checkbox['exact_solution'].observe(self._toggle_exact_solution,
                                            'value')
         widget['checkbox'] = checkbox
 
         widget['amplitude_slider'] = IntSlider(
             value=int(self._state['dipole_amplitude'] * 1e9),
-            min=5, max=100, step=5, continuous_update=False)
+            min=5, max=100, step=5, continuous_update=True)
         widget['amplitude_slider'].observe(self._handle_amp_change,
                                            names='value')
         widget['label']['amplitude_slider'] = Label('Dipole amplitude in nAm')
@@ -209,6 +316,8 @@ class App:
         widget['title'] = HTML(value='<h2>Dipole Simulator</h2>')
 
         widget['output'] = output_widget
+
+        init_overlays(widget)
         return widget
 
     def _init_markers(self):
@@ -225,8 +334,13 @@ class App:
 
     def _toggle_updating_state(self):
         self._state['updating'] = not self._state['updating']
+        self._update_updating_label()
 
-        if self._state['updating']:
+    def _update_updating_label(self):
+        evaluating = self._evaluator is not None and self._evaluator.pending
+        if self._startup_steps:
+            self._widget['label']['updating'].value = 'Loading …'
+        elif self._state['updating'] or evaluating:
             self._widget['label']['updating'].value = 'Updating …'
         else:
             self._widget['label']['updating'].value = 'Ready.'
@@ -254,6 +368,9 @@ class App:
         remaining_idx = axis
 
         if state['mode'] == 'slice_browser':
+            # This removes the dipole, so don't render its field.
+            if self._evaluator is not None:
+                self._evaluator.cancel()
             handle_click_in_slice_browser_mode(
                 widget=widget, markers=markers, state=state, x=x, y=y,
                 x_idx=x_idx, y_idx=y_idx, evoked=self._evoked,
@@ -263,7 +380,7 @@ class App:
             handle_click_in_set_dipole_pos_mode(
                 widget=widget, state=self._state, x_idx=x_idx, y_idx=y_idx,
                 remaining_idx=remaining_idx, x=x, y=y,
-                ras_to_head_t=self._ras_to_head_t,
+                geometry=self._geometry,
                 evoked=self._evoked
             )
         elif state['mode'] == 'set_dipole_ori':
@@ -271,26 +388,73 @@ class App:
             handle_click_in_set_dipole_ori_mode(
                 widget=widget, state=self._state, x_idx=x_idx, y_idx=y_idx,
                 remaining_idx=remaining_idx, x=x, y=y,
-                ras_to_head_t=self._ras_to_head_t,
+                geometry=self._geometry,
                 evoked=self._evoked
             )
 
         self._plot_dipole_markers_and_arrow()
+        redraw_overlays(widget)
         self._enable_crosshair_cursor()
 
         if (state['dipole_pos']['x'] is not None and
                 state['dipole_ori']['x'] is not None and
                 state['dipole_pos'] != state['dipole_ori']):
-            plot_evoked(widget, state, fwd_path=self._fwd_path,
-                        subject=self._subject, info=self._info,
-                        ras_to_head_t=self._ras_to_head_t,
-                        exact_solution=self._exact_solution,
-                        bem_path=self._bem_path, head_to_mri_t=self._trans,
-                        fwd_lookup_table=self._fwd_lookup_table,
-                        t1_img=self._t1_img)
+            self._plot_evoked()
 
         self._toggle_updating_state()
 
+    def _plot_evoked(self):
+        simulator = self._simulator
+        if simulator.exact_solution and not simulator.forward_engine_ready:
+            print('Preparing exact forward calculations, please wait …')
+
+        # Take a snapshot of the dipole, as the state may change while we're
+        # computing its field in the background.
+        state = self._state
+        dipole_pos = tuple(state['dipole_pos'][axis] for axis in 'xyz')
+        dipole_ori = tuple(state['dipole_ori'][axis] for axis in 'xyz')
+        exact_solution = simulator.exact_solution
+
+        def compute():
+            # The field of a 1 Am dipole; we scale it to the amplitude that
+            # is current when rendering.
+            meeg_data = simulator.compute_field(
+                pos=dipole_pos, ori=dipole_ori,
+                exact_solution=exact_solution)
+            return dipole_pos, dipole_ori, meeg_data
+
+        if self._evaluator is None:
+            self._render_evoked(compute(), output='')
+            return
+
+        self._evaluator.submit(compute=compute,
+                               render=self._render_evoked,
+                               on_error=self._handle_evaluation_error)
+        self._update_updating_label()
+
+    @output_widget.capture()
+    def _render_evoked(self, result, output):
+        self._update_updating_label()
+        dipole_pos, dipole_ori, meeg_data = result
+
+        # The dipole may have been changed or removed (e.g., by a click in
+        # the slice browser) while we were computing its field.
+        state = self._state
+        if (dipole_pos != tuple(state['dipole_pos'][axis] for axis in 'xyz')
+                or dipole_ori != tuple(state['dipole_ori'][axis]
+                                       for axis in 'xyz')):
+            return
+
+        print(output, end='')
+        self._init_topomap_renderers()
+        render_evoked_field(self._widget, state, meeg_data=meeg_data)
+
+    @output_widget.capture()
+    def _handle_evaluation_error(self, exc, output):
+        self._update_updating_label()
+        print(output, end='')
+        raise exc
+
     def _handle_slice_mouse_enter(self, event):
         pass
 
@@ -303,26 +467,23 @@ class App:
         state = self._state
         widget = self._widget
 
-        widget['amplitude_slider'].disabled = True
-
         new_amp = change['new'] * 1e-9
         self._state['dipole_amplitude'] = new_amp
 
         if (state['dipole_pos']['x'] is not None and
                 state['dipole_ori']['x'] is not None and
-                state['dipole_pos'] != state['dipole_ori']):
-            plot_evoked(widget, state, fwd_path=self._fwd_path,
-                        subject=self._subject, info=self._info,
-                        ras_to_head_t=self._ras_to_head_t,
-                        exact_solution=self._exact_solution,
-                        bem_path=self._bem_path, head_to_mri_t=self._trans,
-                        fwd_lookup_table=self._fwd_lookup_table,
-                        t1_img=self._t1_img)
+                state['dipole_pos'] != state['dipole_ori'] and
+                not rescale_topomaps(widget=widget, state=state)):
+            # The topomaps will be drawn at whatever amplitude is current
+            # then, so there's no need to block the slider meanwhile.
+            self._plot_evoked()
+
         self._toggle_updating_state()
-        widget['amplitude_slider'].disabled = False
 
     def _handle_reset_button_click(self, button):
         self._toggle_updating_state()
+        if self._evaluator is not None:
+            self._evaluator.cancel()
         widget = self._widget
         markers = self._markers
         state = self._state
@@ -334,6 +495,7 @@ class App:
 
         self._state = self._init_state()
         self._plot_slice(axis='all')
+        redraw_overlays(widget)
         reset_topomaps(widget=widget, evoked=self._evoked)
         widget['label']['dipole_pos'].value = 'Not set'
         widget['label']['dipole_ori'].value = 'Not set'
@@ -369,25 +531,20 @@ class App:
         widget = self._widget
 
         update_dipole_pos(dipole_pos_ras=pos,
-                          ras_to_head_t=self._ras_to_head_t,
+                          geometry=self._geometry,
                           widget=self._widget, evoked=self._evoked)
         update_dipole_ori(dipole_ori_ras=ori,
-                          ras_to_head_t=self._ras_to_head_t,
+                          geometry=self._geometry,
                           widget=self._widget, evoked=self._evoked)
         self._plot_slice(axis='all')
         draw_dipole_if_necessary(state=self._state, widget=self._widget,
                                  markers=self._markers)
+        redraw_overlays(self._widget)
 
         if (state['dipole_pos']['x'] is not None and
                 state['dipole_ori']['x'] is not None and
                 state['dipole_pos'] != state['dipole_ori']):
-            plot_evoked(widget, state, fwd_path=self._fwd_path,
-                        subject=self._subject, info=self._info,
-                        ras_to_head_t=self._ras_to_head_t,
-                        exact_solution=self._exact_solution,
-                        bem_path=self._bem_path, head_to_mri_t=self._trans,
-                        fwd_lookup_table=self._fwd_lookup_table,
-                        t1_img=self._t1_img)
+            self._plot_evoked()
 
         self._toggle_updating_state()
 
@@ -448,7 +605,7 @@ class App:
     def _gen_app_layout(self):
         title = self._widget['title']
         toggle_buttons = self._widget['toggle_buttons']
-        # checkbox = self._widget['checkbox']
+        checkbox = self._widget['checkbox']
         label = self._widget['label']
         fig = self._widget['fig']
         topomap_fig = self._widget['topomap_fig']
@@ -463,14 +620,10 @@ class App:
             [HBox([label['dipole_pos_'], label['dipole_pos']]),
              HBox([label['dipole_ori_'], label['dipole_ori']])])
 
-        # dipole_amp_and_exact_sol_col = VBox(
-        #     [label['amplitude_slider'],
-        #      dipole_amp_slider,
-        #      checkbox['exact_solution']])
-
         dipole_amp_col = VBox(
             [dipole_amp_slider,
-             label['amplitude_slider']])
+             label['amplitude_slider'],
+             checkbox['exact_solution']])
 
         grid = GridspecLayout(3, 3, grid_gap='0', width="95%")
         grid[0, 0] = HBox([label['status'], label['updating']])
@@ -483,7 +636,6 @@ class App:
                                          width='100%'))
 
         main_tab = VBox([grid,
-                         #   dipole_amp_and_exact_sol_col]),
                          HBox([VBox([label['axis']['x'], fig['x'].canvas],
                                     layout=Layout(align_items='center')),
                                VBox([label['axis']['y'], fig['y'].canvas],
@@ -557,8 +709,29 @@ class App:
 
         self._app_layout = app
 
+    def close(self):
+        """Stop the background evaluation and downloads.
+        """
+        if self._evaluator is not None:
+            self._evaluator.shutdown()
+        self._simulator.shutdown()
+
     def display(self):
         IPython.display.display(self._app_layout)
+        if not self._startup_steps or self._startup_scheduled:
+            return
+
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            loop = None
+
+        if loop is None:
+            while self._startup_steps:
+                self._run_startup_step()
+        else:
+            self._startup_scheduled = True
+            loop.call_soon(self._run_startup_steps_in_loop, loop)
 
 
 if __name__ == '__main__':
@@ -8,10 +8,11 @@ from dipole import (remove_dipole_arrows,
                     update_dipole_pos, update_dipole_ori,
                     draw_dipole_if_necessary)
 from cursor import enable_crosshair_cursor
+from overlay import redraw_overlays
 
 
 def handle_click(
-    *, event, widget, markers, state, evoked, ras_to_head_t, img_data
+    *, event, widget, markers, state, evoked, geometry, img_data
 ):
     if event.button != MouseButton.LEFT:
         return
@@ -39,17 +40,18 @@ def handle_click(
         handle_click_in_set_dipole_pos_mode(
             widget=widget, state=state, x_idx=x_idx, y_idx=y_idx,
             remaining_idx=remaining_idx, x=x, y=y,
-            ras_to_head_t=ras_to_head_t, evoked=evoked
+            geometry=geometry, evoked=evoked
         )
     elif state['mode'] == 'set_dipole_ori':
         # Construct the 3D coordinates of the clicked-on point
         handle_click_in_set_dipole_ori_mode(
             widget=widget, state=state, x_idx=x_idx, y_idx=y_idx,
             remaining_idx=remaining_idx, x=x, y=y,
-            ras_to_head_t=ras_to_head_t, evoked=evoked
+            geometry=geometry, evoked=evoked
         )
 
     draw_dipole_if_necessary(state, widget, markers)
+    redraw_overlays(widget)
     # draw_crosshairs(widget=widget, state=state)
 
 
@@ -116,7 +118,7 @@ def handle_click_in_slice_browser_mode(
 
 def handle_click_in_set_dipole_pos_mode(
     *, widget, state, x_idx, y_idx,
-    remaining_idx, x, y, ras_to_head_t,
+    remaining_idx, x, y, geometry,
     evoked
 ):
     # for axis in state['dipole_pos'].keys():
@@ -130,14 +132,14 @@ def handle_click_in_set_dipole_pos_mode(
 
     state['dipole_pos'] = dipole_pos_ras
     update_dipole_pos(dipole_pos_ras=dipole_pos_ras,
-                      ras_to_head_t=ras_to_head_t,
+                      geometry=geometry,
                       widget=widget, evoked=evoked)
     leave_set_dipole_pos_mode()
 
 
 def handle_click_in_set_dipole_ori_mode(
     *, widget, state, x_idx, y_idx,
-    remaining_idx, x, y, ras_to_head_t,
+    remaining_idx, x, y, geometry,
     evoked
 ):
     dipole_ori_ras = dict()
@@ -147,6 +149,6 @@ def handle_click_in_set_dipole_ori_mode(
 
     state['dipole_ori'] = dipole_ori_ras
     update_dipole_ori(dipole_ori_ras=dipole_ori_ras,
-                      ras_to_head_t=ras_to_head_t,
+                      geometry=geometry,
                       widget=widget, evoked=evoked)
     leave_set_dipole_ori_mode()
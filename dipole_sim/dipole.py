@@ -1,16 +1,15 @@
-from mne.transforms import apply_trans
+from transforms import ras_to_head
+from overlay import add_overlay
 from evoked_field import reset_topomaps
 
 
 def remove_dipole_arrows(widget):
-    for axis, fig in widget['fig'].items():
-        ax = widget['fig'][axis].axes[0]
+    for fig in widget['fig'].values():
+        ax = fig.axes[0]
         for child in ax.get_children():
             if child.get_label() == 'dipole_arrow':
                 child.remove()
 
-        fig.canvas.draw()
-
 
 def draw_dipole_arrows(widget, state):
     remove_dipole_arrows(widget)
@@ -32,11 +31,9 @@ def draw_dipole_arrows(widget, state):
         dx = state['dipole_ori'][x_idx] - state['dipole_pos'][x_idx]
         dy = state['dipole_ori'][y_idx] - state['dipole_pos'][y_idx]
 
-        ax.arrow(x=x, y=y, dx=dx, dy=dy, facecolor='white', edgecolor='black',
-                 width=5, head_width=15, length_includes_head=True,
-                 label='dipole_arrow')
-
-        fig.canvas.draw()
+        add_overlay(ax.arrow(x=x, y=y, dx=dx, dy=dy, facecolor='white',
+                             edgecolor='black', width=5, head_width=15,
+                             length_includes_head=True, label='dipole_arrow'))
 
 
 def plot_dipole_pos_marker(widget, markers, state):
@@ -56,11 +53,9 @@ def plot_dipole_pos_marker(widget, markers, state):
         y = state['dipole_pos'][y_idx]
 
         ax = widget['fig'][axis].axes[0]
-        markers['dipole_pos'][axis] = ax.scatter(x, y, marker='o', s=50,
-                                                 facecolors='r',
-                                                 edgecolors='r',
-                                                 label='dipole_pos_marker')
-        widget['fig'][axis].canvas.draw()
+        markers['dipole_pos'][axis] = add_overlay(
+            ax.scatter(x, y, marker='o', s=50, facecolors='r', edgecolors='r',
+                       label='dipole_pos_marker'))
         # FIXME there must be a public function fore this?
         ax.figure.canvas._cursor = 'crosshair'
 
@@ -71,7 +66,6 @@ def remove_dipole_pos_markers(widget, markers, state):
         if markers['dipole_pos'][axis] is not None:
             markers['dipole_pos'][axis].remove()
             markers['dipole_pos'][axis] = None
-            widget['fig'][axis].canvas.draw()
         # FIXME there must be a public function fore this?
         ax.figure.canvas._cursor = 'crosshair'
 
@@ -93,10 +87,9 @@ def plot_dipole_ori_marker(widget, markers, state):
         y = state['dipole_ori'][y_idx]
 
         ax = widget['fig'][axis].axes[0]
-        markers['dipole_ori'][axis] = ax.scatter(x, y, marker='x', s=50,
-                                                 facecolors='r',
-                                                 label='dipole_ori_marker')
-        widget['fig'][axis].canvas.draw()
+        markers['dipole_ori'][axis] = add_overlay(
+            ax.scatter(x, y, marker='x', s=50, facecolors='r',
+                       label='dipole_ori_marker'))
         # FIXME there must be a public function fore this?
         ax.figure.canvas._cursor = 'crosshair'
 
@@ -107,17 +100,15 @@ def remove_dipole_ori_markers(widget, markers, state):
         if markers['dipole_ori'][axis] is not None:
             markers['dipole_ori'][axis].remove()
             markers['dipole_ori'][axis] = None
-            widget['fig'][axis].canvas.draw()
         # FIXME there must be a public function fore this?
         ax.figure.canvas._cursor = 'crosshair'
 
 
-def update_dipole_pos(dipole_pos_ras, ras_to_head_t, widget, evoked):
-    dipole_pos_head = apply_trans(trans=ras_to_head_t,
+def update_dipole_pos(dipole_pos_ras, geometry, widget, evoked):
+    dipole_pos_head = ras_to_head(geometry=geometry,
                                   pts=(dipole_pos_ras['x'],
                                        dipole_pos_ras['y'],
                                        dipole_pos_ras['z']))
-    dipole_pos_head /= 1000
     dipole_pos_head = dict(x=dipole_pos_head[0], y=dipole_pos_head[1],
                            z=dipole_pos_head[2])
 
@@ -131,12 +122,11 @@ def update_dipole_pos(dipole_pos_ras, ras_to_head_t, widget, evoked):
     reset_topomaps(widget=widget, evoked=evoked)
 
 
-def update_dipole_ori(dipole_ori_ras, ras_to_head_t, widget, evoked):
-    dipole_ori_head = apply_trans(trans=ras_to_head_t,
+def update_dipole_ori(dipole_ori_ras, geometry, widget, evoked):
+    dipole_ori_head = ras_to_head(geometry=geometry,
                                   pts=(dipole_ori_ras['x'],
                                        dipole_ori_ras['y'],
                                        dipole_ori_ras['z']))
-    dipole_ori_head /= 1000
     dipole_ori_head = dict(x=dipole_ori_head[0], y=dipole_ori_head[1],
                            z=dipole_ori_head[2])
 
@@ -1,4 +1,128 @@
-import requests
+import hashlib
+import os
+import threading
+import time
+
+
+GITHUB_DATA_URL = ('https://github.com/hoechenberger/dipoles_demo_data/'
+                   'raw/master/data')
+
+# Timeouts for establishing a connection and for waiting for data, in seconds.
+DOWNLOAD_TIMEOUT = (10, 30)
+DOWNLOAD_RETRIES = 3
+DOWNLOAD_BACKOFF = 0.5  # Seconds, doubled after each attempt.
+
+# Server responses that are worth retrying.
+_TRANSIENT_STATUS_CODES = (408, 429, 500, 502, 503, 504)
+
+_local = threading.local()
+
+
+class _TransientDownloadError(Exception):
+    pass
+
+
+def _get_session():
+    # requests.Session is not guaranteed to be thread-safe, so every thread
+    # (e.g. of the prefetcher) gets its own, which keeps its connections
+    # alive across downloads.
+    session = getattr(_local, 'session', None)
+    if session is None:
+        # requests is only imported once we actually need to download
+        # something.
+        import requests
+        from requests.adapters import HTTPAdapter
+
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=4)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        _local.session = session
+    return session
+
+
+def _parse_checksum(checksum):
+    # Checksums are passed like Zenodo reports them, e.g. "md5:<hex digest>".
+    algorithm, _, digest = checksum.partition(':')
+    if not digest or algorithm not in hashlib.algorithms_available:
+        raise ValueError(f'Invalid checksum: {checksum}')
+    return algorithm, digest.lower()
+
+
+def _download_file_once(url, fname, checksum, timeout, chunk_size):
+    tmp_suffix = f'.{os.getpid()}-{threading.get_ident()}.tmp'
+    tmp_fname = fname.with_name(fname.name + tmp_suffix)
+    if checksum is not None:
+        algorithm, expected_digest = _parse_checksum(checksum)
+        file_hash = hashlib.new(algorithm)
+
+    try:
+        with _get_session().get(url, stream=True, timeout=timeout,
+                                allow_redirects=True) as response:
+            if response.status_code in _TRANSIENT_STATUS_CODES:
+                raise _TransientDownloadError(
+                    f'Server responded with status {response.status_code}')
+            if response.status_code != 200:
+                raise RuntimeError(f'Server responded with status '
+                                   f'{response.status_code}')
+
+            # The length refers to the encoded content, so we can only
+            # check it if the content isn't compressed during transfer.
+            expected_size = response.headers.get('Content-Length')
+            if response.headers.get('Content-Encoding', 'identity') not in (
+                    'identity', ''):
+                expected_size = None
+
+            size = 0
+            with open(tmp_fname, 'wb') as f:
+                for chunk in response.iter_content(chunk_size=chunk_size):
+                    f.write(chunk)
+                    size += len(chunk)
+                    if checksum is not None:
+                        file_hash.update(chunk)
+                f.flush()
+                os.fsync(f.fileno())
+
+        if expected_size is not None and size != int(expected_size):
+            raise _TransientDownloadError(f'Received {size} of '
+                                          f'{expected_size} bytes')
+        if checksum is not None and file_hash.hexdigest() != expected_digest:
+            raise _TransientDownloadError('Checksum mismatch')
+
+        # Only now that it's complete, the file becomes visible.
+        os.replace(tmp_fname, fname)
+    finally:
+        if tmp_fname.exists():
+            tmp_fname.unlink()
+
+
+def download_file(url, fname, checksum=None, timeout=DOWNLOAD_TIMEOUT,
+                  retries=DOWNLOAD_RETRIES, backoff=DOWNLOAD_BACKOFF,
+                  chunk_size=1024 * 1024):
+    """Download a file.
+
+    The file is streamed to disk in chunks, and only moved to fname once it
+    has been received completely (and, if a checksum like "md5:<hex digest>"
+    is passed, verified). Connection problems, timeouts, incomplete
+    transfers, and temporary server errors are retried with exponential
+    backoff.
+
+    Raises RuntimeError if the download fails.
+    """
+    import requests
+
+    for attempt in range(retries + 1):
+        try:
+            _download_file_once(url=url, fname=fname, checksum=checksum,
+                                timeout=timeout, chunk_size=chunk_size)
+            return
+        except (_TransientDownloadError, requests.ConnectionError,
+                requests.Timeout, requests.exceptions.ChunkedEncodingError) \
+                as e:
+            if attempt == retries:
+                raise RuntimeError(f'Download failed after {retries + 1} '
+                                   f'attempts: {e}') from e
+            time.sleep(backoff * 2 ** attempt)
 
 
 def download_fwd_from_zenodo(fwd_path, subject, dipole_pos,
@@ -12,16 +136,22 @@ def download_fwd_from_zenodo(fwd_path, subject, dipole_pos,
     for file in zenodo_files:
         if file['key'] == fname:
             fwd_url = file['links']['self']
-            fwd_request = requests.get(fwd_url)
-            with open(fwd_path / fname, 'wb') as f:
-                f.write(fwd_request.content)
-
+            download_file(url=fwd_url, fname=fwd_path / fname,
+                          checksum=file.get('checksum'))
             return
 
     raise RuntimeError('Could not find the requested forward solution online!')
 
 
-def download_fwd_from_github(fwd_path, subject, dipole_pos, overwrite=False):
+def download_fwd_from_github(fwd_path, subject, dipole_pos, overwrite=False,
+                             base_url=GITHUB_DATA_URL):
+    """Download the pre-calculated forward solution of a grid node.
+
+    Unlike Zenodo, GitHub publishes no checksums for raw files, and the data
+    repository doesn't ship a manifest of its own, so the downloads are
+    verified against the Content-Length only (truncated files typically
+    fail to be read by MNE, too). Files are only replaced once complete.
+    """
     fname = (f'{subject}-'
              f'{dipole_pos[0]:.3f}-'
              f'{dipole_pos[1]:.3f}-'
@@ -30,31 +160,28 @@ def download_fwd_from_github(fwd_path, subject, dipole_pos, overwrite=False):
     if (fwd_path / fname).exists() and not overwrite:
         return
 
-    fwd_url = (f'https://github.com/hoechenberger/dipoles_demo_data/'
-               f'raw/master/data/fwd/{fname}')
-    fwd_request = requests.get(fwd_url, allow_redirects=True)
-    if fwd_request.status_code != 200:
+    fwd_url = f'{base_url}/fwd/{fname}'
+    try:
+        download_file(url=fwd_url, fname=fwd_path / fname)
+    except RuntimeError as e:
         msg = (f'Could not download the requested forward solution from '
-               f'GitHub!\nDownload URL was: {fwd_url}')
+               f'GitHub!\nDownload URL was: {fwd_url}\n{e}')
         raise RuntimeError(msg)
 
-    with open(fwd_path / fname, 'wb') as f:
-        f.write(fwd_request.content)
 
-
-def download_bem_from_github(data_path, subject, overwrite=False):
+def download_bem_from_github(data_path, subject, overwrite=False,
+                             base_url=GITHUB_DATA_URL):
+    """Download the BEM solution, see download_fwd_from_github().
+    """
     fname = f'{subject}-bem-sol.fif'
 
     if (data_path / fname).exists() and not overwrite:
         return
 
-    bem_url = (f'https://github.com/hoechenberger/dipoles_demo_data/'
-               f'raw/master/data/{fname}')
-    bem_request = requests.get(bem_url, allow_redirects=True)
-    if bem_request.status_code != 200:
+    bem_url = f'{base_url}/{fname}'
+    try:
+        download_file(url=bem_url, fname=data_path / fname)
+    except RuntimeError as e:
         msg = (f'Could not download the requested BEM solution from '
-               f'GitHub!\nDownload URL was: {bem_url}')
+               f'GitHub!\nDownload URL was: {bem_url}\n{e}')
         raise RuntimeError(msg)
-
-    with open(data_path / fname, 'wb') as f:
-        f.write(bem_request.content)
@@ -0,0 +1,135 @@
+import asyncio
+import io
+import sys
+import threading
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+
+
+_local = threading.local()
+
+
+class _ThreadStdout:
+    # Sends what the current thread prints to its buffer, if it has one; all
+    # other threads print as usual.
+    def __init__(self, stdout):
+        self._stdout = stdout
+
+    def write(self, text):
+        buffer = getattr(_local, 'buffer', None)
+        return (self._stdout if buffer is None else buffer).write(text)
+
+    def flush(self):
+        self._stdout.flush()
+
+    def __getattr__(self, name):
+        return getattr(self._stdout, name)
+
+
+@contextmanager
+def _capture_stdout():
+    # Unlike contextlib.redirect_stdout(), this only affects the current
+    # thread.
+    if not isinstance(sys.stdout, _ThreadStdout):
+        sys.stdout = _ThreadStdout(sys.stdout)
+    _local.buffer = buffer = io.StringIO()
+    try:
+        yield buffer
+    finally:
+        _local.buffer = None
+
+
+class AsyncEvaluator:
+    """Evaluate the dipole field in a background thread.
+
+    Only the most recent request is of interest: a request that is still
+    queued when a new one comes in is cancelled, and the result of a request
+    that was superseded while running is discarded. This way, rapid
+    successive clicks coalesce into a single evaluation for the latest
+    dipole.
+
+    Results are passed to the render callback in the thread running the
+    event loop (in Jupyter, the one handling the widget events), along with
+    everything compute() printed, so it can be shown where it belongs.
+    Without a running event loop, requests are evaluated synchronously, and
+    the output is printed right away.
+    """
+
+    def __init__(self):
+        # A single worker, so evaluations never run concurrently.
+        self._executor = ThreadPoolExecutor(max_workers=1,
+                                            thread_name_prefix='evaluate')
+        self._generation = 0
+        self._future = None
+        self._pending = False
+
+    @property
+    def pending(self):
+        """Whether the result of the latest request has yet to be rendered.
+        """
+        return self._pending
+
+    def _run(self, generation, compute):
+        if generation != self._generation:
+            return None, '', None  # Superseded while queued; discarded.
+
+        with _capture_stdout() as buffer:
+            try:
+                result, exc = compute(), None
+            except Exception as e:
+                result, exc = None, e
+        return result, buffer.getvalue(), exc
+
+    def _deliver(self, future, generation, render, on_error):
+        if generation != self._generation or future.cancelled():
+            return
+
+        self._pending = False
+        result, output, exc = future.result()
+        if exc is not None:
+            on_error(exc, output)
+        else:
+            render(result, output)
+
+    def submit(self, compute, render, on_error):
+        """Evaluate compute() in the background, and pass its result and
+        printed output to render(), or the exception it raised (and the
+        output) to on_error().
+
+        compute() must not touch any widgets. Requests submitted earlier
+        are superseded.
+        """
+        self.cancel()
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            loop = None
+
+        if loop is None:
+            try:
+                result = compute()
+            except Exception as e:
+                on_error(e, '')
+            else:
+                render(result, '')
+            return
+
+        generation = self._generation
+        self._pending = True
+        self._future = self._executor.submit(self._run, generation, compute)
+        self._future.add_done_callback(
+            lambda future: loop.call_soon_threadsafe(
+                self._deliver, future, generation, render, on_error))
+
+    def cancel(self):
+        """Discard the result of any outstanding request.
+        """
+        self._generation += 1
+        self._pending = False
+        if self._future is not None:
+            self._future.cancel()
+            self._future = None
+
+    def shutdown(self):
+        self.cancel()
+        self._executor.shutdown(wait=False)
@@ -1,29 +1,101 @@
+import os
 import numpy as np
 from functools import partial
-import pandas as pd
 import mne
 
 
-def gen_forward_solution(pos, bem, info, trans, verbose=True):
-    # NOTE:
-    # Both, dipole amplitude and orientation, are set to arbitrary values
-    # here: They are merely required to instantiate a Dipole object, which
-    # we then use to conveniently retrieve a forward solution via
-    # `make_forward_dipole()`. This forward solution is returned in "fixed"
-    # orientation. We then convert it back to "free" orientation mode before
-    # returning the forward object.
-
-    amplitude = np.array([1]).reshape(1,)  # Arbitraty amplitude.
-    ori = np.array([1., 1., 1.]).reshape(1, 3)  # Arbitrary orientation.
-    ori /= np.linalg.norm(ori)
-    pos = pos.reshape(1, 3)
-    gof = np.array([100]).reshape(1,)
-    dip = mne.Dipole(times=[0], pos=pos, ori=ori,
-                     amplitude=amplitude, gof=gof)
-    fwd, _ = mne.make_forward_dipole(dip, bem=bem, info=info, trans=trans,
-                                     verbose=verbose)
-    fwd = mne.convert_forward_solution(fwd, force_fixed=False, verbose=verbose)
-    return fwd
+FWD_LOOKUP_TABLE_FNAME = 'fwd_lookup_table.npz'
+
+
+def create_forward_engine(bem, info, trans):
+    """Prepare everything needed to compute forward solutions quickly.
+
+    ``make_forward_dipole()`` reads the coil definitions, sets up the sensors,
+    and composes the BEM field computation matrices every time it is called.
+    None of this depends on the dipole position, so we do it only once here,
+    like MNE's dipole fitting does internally. Afterwards, computing a
+    leadfield via compute_leadfields() is cheap.
+    """
+    # The forward machinery is only needed for exact solutions, so we don't
+    # import it on startup.
+    from mne.transforms import _ensure_trans
+    from mne.surface import _CheckInside
+    from mne.bem import _bem_find_surface
+    from mne.forward._make_forward import (_prep_meg_channels,
+                                           _prep_eeg_channels, _setup_bem)
+    from mne.forward._compute_forward import _prep_field_computation
+
+    mri_head_t = _ensure_trans(trans, 'mri', 'head')
+    meg_picks = mne.pick_types(info, meg=True, ref_meg=False, exclude=[])
+    eeg_picks = mne.pick_types(info, meg=False, eeg=True, ref_meg=False,
+                               exclude=[])
+
+    megcoils, compcoils, megnames, meg_info = [], [], [], None
+    eegels, eegnames = [], []
+    if len(meg_picks) > 0:
+        megcoils, compcoils, megnames, meg_info = \
+            _prep_meg_channels(info, verbose=False)
+    if len(eeg_picks) > 0:
+        eegels, eegnames = _prep_eeg_channels(info, verbose=False)
+
+    bem = _setup_bem(bem, '', len(eegnames), mri_head_t, verbose=False)
+    fwd_data = dict(coils_list=[megcoils, eegels],
+                    ccoils_list=[compcoils, None],
+                    infos=[meg_info, None],
+                    coil_types=['meg', 'eeg'])
+    _prep_field_computation(None, bem, fwd_data, n_jobs=1, verbose=False)
+
+    if bem['is_sphere']:
+        check_inside = head_mri_t = inner_skull_pos = None
+    else:
+        inner_skull = _bem_find_surface(bem, 'inner_skull')
+        check_inside = _CheckInside(inner_skull)
+        head_mri_t = bem['head_mri_t']
+        inner_skull_pos = mne.transforms.apply_trans(mri_head_t,
+                                                     inner_skull['rr'])
+
+    # The forward solution is computed for MEG first, then EEG. Bring the
+    # channels into the order of info.
+    fwd_ch_names = megnames + eegnames
+    ch_order = np.array([fwd_ch_names.index(ch_name)
+                         for ch_name in info['ch_names']])
+
+    engine = dict(fwd_data=fwd_data,
+                  check_inside=check_inside,
+                  head_mri_t=head_mri_t,
+                  inner_skull_pos=inner_skull_pos,
+                  ch_order=ch_order)
+    return engine
+
+
+def check_inside_skull(engine, pos):
+    """Check which positions (in m, MNE Head) are inside the inner skull.
+    """
+    pos = np.asarray(pos).reshape(-1, 3)
+    if engine['check_inside'] is None:
+        return np.ones(len(pos), dtype=bool)
+
+    pos_mri = mne.transforms.apply_trans(engine['head_mri_t'], pos)
+    return engine['check_inside'](pos_mri, verbose=False)
+
+
+def compute_leadfields(engine, pos, n_jobs=1):
+    """Compute the "free" orientation leadfields for dipole positions.
+
+    pos is an array of shape (n_dipoles, 3), in meters (MNE Head
+    coordinates); all positions must be inside the inner skull.
+
+    Returns an array of shape (n_dipoles, n_channels, 3).
+    """
+    from mne.forward._compute_forward import _compute_forwards_meeg
+
+    pos = np.ascontiguousarray(pos, dtype=np.float64).reshape(-1, 3)
+    Bs = _compute_forwards_meeg(pos, engine['fwd_data'], n_jobs=n_jobs,
+                                silent=True)
+    # Shape (n_dipoles * 3, n_channels) -> (n_dipoles, n_channels, 3)
+    leadfield = np.concatenate(Bs, axis=1)[:, engine['ch_order']]
+    leadfield = leadfield.reshape(len(pos), 3, -1).transpose(0, 2, 1)
+    return leadfield
 
 
 def _create_format_coord(axis):
@@ -55,13 +127,69 @@ def _create_format_coord(axis):
     return partial(format_coord, x_label=x_label, y_label=y_label)
 
 
-def load_fwd_lookup_table(fwd_path):
-    lookup_table_fname = 'fwd_lookup_table.csv'
-    lookup_table_path = fwd_path / lookup_table_fname
+def write_fwd_lookup_table(fwd_path, grid, fwd_exists):
+    """Write the forward solution lookup table in its binary form.
+
+    The boolean volume is packed into bits (in C order) and stored alongside
+    the grid it refers to, which takes about 16 KB for a 50 x 50 x 50 grid.
+    """
+    fname = fwd_path / FWD_LOOKUP_TABLE_FNAME
+    tmp_fname = fname.with_name(fname.name + '.tmp')
+    fwd_exists = np.asarray(fwd_exists, dtype=bool).reshape(grid['shape'])
+
+    with open(tmp_fname, 'wb') as f:
+        np.savez(f, fwd_exists=np.packbits(fwd_exists.ravel()),
+                 shape=np.array(grid['shape'], dtype=np.int64),
+                 origin=np.array(grid['origin'], dtype=np.float64),
+                 spacing=np.array(grid['spacing'], dtype=np.float64))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_fname, fname)
+
+
+def _read_fwd_lookup_table_npz(lookup_table_path, grid):
+    with np.load(lookup_table_path) as lookup_table:
+        shape = tuple(int(n) for n in lookup_table['shape'])
+        # The grid is derived from the digitization points; allow for
+        # rounding to µm.
+        if (shape != tuple(grid['shape']) or
+                not np.allclose(lookup_table['origin'], grid['origin'],
+                                rtol=0, atol=1e-6) or
+                not np.allclose(lookup_table['spacing'], grid['spacing'],
+                                rtol=0, atol=1e-6)):
+            raise RuntimeError(f'The forward solution lookup table does not '
+                               f'match the grid: {lookup_table_path}')
+
+        fwd_exists = np.unpackbits(lookup_table['fwd_exists'],
+                                   count=int(np.prod(shape)))
+    return fwd_exists.astype(bool).reshape(shape)
+
+
+def _read_fwd_lookup_table_csv(lookup_table_path, grid):
+    import pandas as pd
+    lookup_table = pd.read_csv(lookup_table_path)
+
+    # The lookup table was generated by iterating over the grid in C order,
+    # so we can simply reshape it into a volume.
+    if len(lookup_table) != np.prod(grid['shape']):
+        raise RuntimeError(f'The forward solution lookup table does not '
+                           f'match the grid: {lookup_table_path}')
+
+    fwd_exists = lookup_table['success'].to_numpy(dtype=bool)
+    fwd_exists = fwd_exists.reshape(grid['shape'])
+    return fwd_exists
+
+
+def load_fwd_lookup_table(fwd_path, grid):
+    """Load the forward solution lookup table as a boolean volume, indicating
+    for each node of the grid whether a forward solution exists.
+
+    The binary table (see write_fwd_lookup_table()) is used if it exists;
+    otherwise, we fall back to parsing the CSV table.
+    """
+    lookup_table_path = fwd_path / FWD_LOOKUP_TABLE_FNAME
+    if lookup_table_path.exists():
+        return _read_fwd_lookup_table_npz(lookup_table_path, grid=grid)
 
-    # Convert to str dtype to work around floating point precision issues
-    lookup_table = pd.read_csv(lookup_table_path,
-                               dtype=dict(x=str, y=str, z=str))
-    lookup_table = lookup_table.rename(columns={'success': 'fwd_exists'})
-    lookup_table = lookup_table.set_index(['x', 'y', 'z'])
-    return lookup_table
+    lookup_table_path = fwd_path / 'fwd_lookup_table.csv'
+    return _read_fwd_lookup_table_csv(lookup_table_path, grid=grid)
@@ -1,12 +1,17 @@
+import hashlib
+import os
 import pathlib
+from functools import partial
 import numpy as np
-import itertools
-from joblib import Parallel, delayed
 import pandas as pd
 import mne
 
-from forward import gen_forward_solution
-from slice import create_head_grid
+from forward import (create_forward_engine, check_inside_skull,
+                     compute_leadfields, write_fwd_lookup_table)
+from leadfield import (leadfield_store_exists, read_leadfield_store,
+                       open_leadfield_store_for_writing, read_store_progress,
+                       write_store_progress, finalize_leadfield_store)
+from grid import create_grid, get_grid_node_pos, create_adaptive_grid
 
 
 data_path = pathlib.Path('../data')
@@ -34,55 +39,154 @@ info['bads'] = []
 del evoked_fname, evoked
 
 
-def gen_forward_files(x, y, z, bem, info, trans, verbose=True):
-    if verbose:
-        msg = (f'Processing forward solution for dipole location: '
-               f'x={x}, y={y}, z={z} [m, MNE Head]')
-        print(msg)
-    pos = np.array([x, y, z])
+def _hash_positions(pos):
+    return hashlib.sha1(np.ascontiguousarray(pos).tobytes()).hexdigest()
 
-    try:
-        fwd = gen_forward_solution(pos=pos, bem=bem, info=info,
-                                   trans=head_to_mri_t, verbose=False)
-        success = True
-    except RuntimeError as e:
-        if 'No points left in source space ' in str(e):
-            if verbose:
-                print('… skipping (location outside skull)')
-            success = False
-        else:
-            raise e
-
-    if success:
-        fwd_fname = fwd_dir / (f'{subject}-'
-                               f'{pos[0]:.3f}-'
-                               f'{pos[1]:.3f}-'
-                               f'{pos[2]:.3f}-fwd.fif')
-        mne.write_forward_solution(fwd_fname, fwd, overwrite=True,
-                                   verbose=False)
-
-    if verbose:
-        print('… done.')
-    return dict(x=x, y=y, z=z, success=success)
 
+def _get_pos_keys(pos):
+    # All positions are rounded to full millimeters.
+    return [tuple(key) for key in np.rint(pos * 1e3).astype(np.int64)]
 
-def main():
-    head_grid_steps = 50
-    head_grid = create_head_grid(info=info, grid_steps=head_grid_steps)
 
-    x_grid = np.round(head_grid[0].squeeze(), 3)
-    y_grid = np.round(head_grid[1].squeeze(), 3)
-    z_grid = np.round(head_grid[2].squeeze(), 3)
+def _read_existing_store(fwd_path, subject, ch_names):
+    if not leadfield_store_exists(fwd_path=fwd_path, subject=subject):
+        return None
 
-    xyz = itertools.product(x_grid, y_grid, z_grid)
-
-    p = Parallel(n_jobs=-1, verbose=50)
-    f = delayed(gen_forward_files)
-    result = p(f(x, y, z, bem=bem, info=info, trans=head_to_mri_t)
-               for x, y, z in xyz)
-
-    df = pd.DataFrame(result)
-    df.to_csv(fwd_lookup_table_fname, index=False)
+    try:
+        store = read_leadfield_store(fwd_path=fwd_path, subject=subject,
+                                     ch_names=ch_names)
+    except RuntimeError as e:
+        print(f'Not re-using the existing leadfield store: {e}')
+        return None
+
+    return store
+
+
+def compute_leadfield_chunks(engine, pos, store, chunk_size,
+                             existing_store=None, n_jobs=1, verbose=True):
+    """Compute the leadfields of all positions chunk by chunk, and write
+    them into the store.
+
+    Completed chunks are recorded in the store, so if we get interrupted,
+    calling this function again with the same positions and chunk size only
+    processes the remaining chunks. Leadfields of positions contained in
+    existing_store (e.g., generated for a coarser or smaller grid) are
+    copied from there instead of being re-computed.
+    """
+    pos_hash = _hash_positions(pos)
+    progress = read_store_progress(store)
+    if (progress is None or progress['pos_hash'] != pos_hash or
+            progress['chunk_size'] != chunk_size):
+        progress = dict(pos_hash=pos_hash, chunk_size=chunk_size,
+                        completed_chunks=[])
+    completed_chunks = set(progress['completed_chunks'])
+
+    if existing_store is None:
+        existing_rows = dict()
+    else:
+        existing_rows = {key: row for row, key in
+                         enumerate(_get_pos_keys(existing_store['pos']))}
+
+    n_chunks = int(np.ceil(len(pos) / chunk_size))
+    for chunk_idx in range(n_chunks):
+        start = chunk_idx * chunk_size
+        stop = min(start + chunk_size, len(pos))
+        if chunk_idx in completed_chunks:
+            if verbose:
+                print(f'Skipping forward solutions {start + 1}–{stop} of '
+                      f'{len(pos)} (already done)')
+            continue
+
+        rows = np.array([existing_rows.get(key, -1)
+                         for key in _get_pos_keys(pos[start:stop])])
+        exists = rows >= 0
+        if verbose:
+            print(f'Processing forward solutions {start + 1}–{stop} of '
+                  f'{len(pos)} ({exists.sum()} re-used) …')
+
+        leadfield = store['leadfield'][start:stop]
+        if exists.any():
+            leadfield[exists] = existing_store['leadfield'][rows[exists]]
+        if not exists.all():
+            leadfield[~exists] = compute_leadfields(
+                engine=engine, pos=pos[start:stop][~exists], n_jobs=n_jobs)
+
+        completed_chunks.add(chunk_idx)
+        progress['completed_chunks'] = sorted(completed_chunks)
+        write_store_progress(store=store, progress=progress)
+
+
+def main(grid_type='regular', grid_steps=50, grid=None, chunk_size=2000,
+         n_jobs=-1, reuse_existing=True, **adaptive_grid_kwargs):
+    """Generate the leadfield store and lookup table.
+
+    For the regular grid, the grid spans the head in grid_steps steps along
+    each axis by default; alternatively, pass a custom grid (see
+    grid.create_grid()). For the adaptive grid, which only covers the inside
+    of the inner skull and is finer close to the cortex, keyword arguments
+    are passed on to grid.create_adaptive_grid(); no lookup table is
+    needed in this case.
+
+    If interrupted, simply run this again to continue where we left off. If
+    reuse_existing is True, nodes contained in an existing store are not
+    re-computed, so extending a grid is cheap.
+    """
+    # Setting up the sensors and the BEM takes a while, but only needs to be
+    # done once.
+    engine = create_forward_engine(bem=bem, info=info, trans=head_to_mri_t)
+
+    if grid_type == 'adaptive':
+        pos, grid_info = create_adaptive_grid(
+            surf_pos=engine['inner_skull_pos'],
+            check_inside=partial(check_inside_skull, engine),
+            **adaptive_grid_kwargs)
+        success = None
+        print(f'The adaptive grid has {len(pos)} nodes.')
+    elif grid_type == 'regular':
+        if grid is None:
+            grid = create_grid(info=info, grid_steps=grid_steps)
+        ijk = np.array(list(np.ndindex(*grid['shape'])))
+        pos = get_grid_node_pos(grid, ijk)  # In C order.
+        grid_info = None
+        del ijk
+
+        # We can only calculate forward solutions inside the inner skull.
+        success = check_inside_skull(engine=engine, pos=pos)
+        print(f'{success.sum()} of {len(pos)} grid nodes are inside the '
+              f'inner skull.')
+        lookup_table = pd.DataFrame(dict(x=pos[:, 0], y=pos[:, 1],
+                                         z=pos[:, 2], success=success))
+        pos = pos[success]
+    else:
+        raise ValueError(f'grid_type must be "regular" or "adaptive", but '
+                         f'got: {grid_type}')
+
+    if reuse_existing:
+        existing_store = _read_existing_store(fwd_path=fwd_dir,
+                                              subject=subject,
+                                              ch_names=info['ch_names'])
+    else:
+        existing_store = None
+
+    store = open_leadfield_store_for_writing(fwd_path=fwd_dir,
+                                             subject=subject,
+                                             n_points=len(pos),
+                                             ch_names=info['ch_names'],
+                                             overwrite=True, resume=True)
+    compute_leadfield_chunks(engine=engine, pos=pos, store=store,
+                             chunk_size=chunk_size,
+                             existing_store=existing_store, n_jobs=n_jobs)
+    del existing_store  # Release the memory-mapped file before replacing it.
+    finalize_leadfield_store(store=store, pos=pos, grid_info=grid_info)
+
+    if success is not None:
+        tmp_fname = fwd_lookup_table_fname.with_name(
+            fwd_lookup_table_fname.name + '.tmp')
+        lookup_table.to_csv(tmp_fname, index=False)
+        os.replace(tmp_fname, fwd_lookup_table_fname)
+        # This is what the app actually reads; the CSV is kept for reference.
+        write_fwd_lookup_table(fwd_path=fwd_dir, grid=grid,
+                               fwd_exists=success)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,162 @@
+import itertools
+import numpy as np
+from scipy.spatial import cKDTree
+
+
+def create_grid(info, grid_steps=50):
+    """Create a descriptor of the regular grid of pre-computed forward
+    solutions.
+
+    The grid spans the maximum extension of the head in each dimension, just
+    like ``slice.create_head_grid()``, but is described only by its origin,
+    spacing, and shape, so positions can be mapped onto grid nodes via
+    simple arithmetic.
+    """
+    dig_pos = np.array([dig['r'] for dig in info['dig']])
+    pos_min = dig_pos.min(axis=0)
+    pos_max = dig_pos.max(axis=0)
+
+    grid = dict(origin=pos_min,
+                spacing=(pos_max - pos_min) / (grid_steps - 1),
+                shape=(grid_steps,) * 3)
+    return grid
+
+
+def snap_to_grid(grid, pos):
+    """Find the indices of the grid nodes closest to the positions in pos.
+
+    pos is an array of shape (..., 3), in meters (MNE Head coordinates).
+    Positions outside of the grid are mapped onto the closest border node.
+    """
+    pos = np.asarray(pos, dtype=np.float64)
+    ijk = np.rint((pos - grid['origin']) / grid['spacing']).astype(np.int64)
+    ijk = np.clip(ijk, 0, np.array(grid['shape']) - 1)
+    return ijk
+
+
+def get_trilinear_weights(grid, pos):
+    """Find the 8 grid nodes surrounding a position, and their trilinear
+    interpolation weights.
+
+    pos is an array of shape (3,), in meters (MNE Head coordinates).
+    Positions outside of the grid are moved onto its border first.
+
+    Returns the node indices, an array of shape (8, 3), and the weights, an
+    array of shape (8,) summing to 1.
+    """
+    shape = np.array(grid['shape'])
+    pos = np.asarray(pos, dtype=np.float64)
+    frac_ijk = (pos - grid['origin']) / grid['spacing']
+    frac_ijk = np.clip(frac_ijk, 0, shape - 1)
+    ijk_0 = np.minimum(np.floor(frac_ijk).astype(np.int64), shape - 2)
+    t = frac_ijk - ijk_0
+
+    # All combinations of the lower (0) and upper (1) node along each axis.
+    corners = np.array(list(itertools.product((0, 1), repeat=3)))
+    ijk = ijk_0 + corners
+    weights = np.prod(np.where(corners, t, 1 - t), axis=1)
+    return ijk, weights
+
+
+def get_grid_node_pos(grid, ijk):
+    """Retrieve the positions of grid nodes, rounded to full millimeters
+    like the positions of our pre-computed forward solutions.
+    """
+    pos = grid['origin'] + np.asarray(ijk) * grid['spacing']
+    return pos.round(3)
+
+
+def create_fwd_index(fwd_exists):
+    """Create a volume mapping each grid node onto the row of its leadfield.
+
+    fwd_exists is a boolean volume indicating for which grid nodes a forward
+    solution exists. Leadfields are stored in grid (C) order, skipping all
+    nodes without a forward solution. Nodes without a forward solution are
+    assigned -1.
+    """
+    fwd_index = np.full(fwd_exists.shape, fill_value=-1, dtype=np.int32)
+    fwd_index[fwd_exists] = np.arange(fwd_exists.sum(), dtype=np.int32)
+    return fwd_index
+
+
+def create_adaptive_grid(surf_pos, check_inside, fine_spacing=0.003,
+                         coarse_spacing=0.006, fine_depth=0.02):
+    """Create the nodes of an adaptive grid inside a surface.
+
+    Instead of spanning the entire head, the grid only covers the inside of
+    a closed surface, typically the inner skull (surf_pos are its vertices,
+    in meters, MNE Head coordinates). Nodes within fine_depth of the surface,
+    where the cortex is located, are spaced fine_spacing apart; deeper
+    nodes, coarse_spacing apart. check_inside is a callable returning which
+    of the passed positions are inside the surface.
+
+    Returns the node positions, an array of shape (n_nodes, 3), rounded to
+    full millimeters, and a description of the grid.
+    """
+    ratio = int(round(coarse_spacing / fine_spacing))
+    if not np.isclose(ratio * fine_spacing, coarse_spacing):
+        raise ValueError('coarse_spacing must be a multiple of fine_spacing')
+
+    # Align the coarse nodes with the fine nodes, so the coarse nodes are a
+    # subset of the lattice of fine nodes.
+    origin = np.floor(surf_pos.min(axis=0) / coarse_spacing) * coarse_spacing
+    shape = np.ceil((surf_pos.max(axis=0) - origin) / fine_spacing) + 1
+    ijk = np.array(list(np.ndindex(*shape.astype(int))))
+    pos = (origin + ijk * fine_spacing).round(3)
+
+    depth, _ = cKDTree(surf_pos).query(pos)
+    is_coarse_node = (ijk % ratio == 0).all(axis=1)
+    keep = (depth <= fine_depth) | is_coarse_node
+    pos = pos[keep]
+    pos = pos[check_inside(pos)]
+
+    grid_info = dict(type='adaptive',
+                     fine_spacing=fine_spacing,
+                     coarse_spacing=coarse_spacing,
+                     fine_depth=fine_depth)
+    return pos, grid_info
+
+
+def create_node_index(pos, max_dist):
+    """Create a spatial index of arbitrarily placed grid nodes.
+
+    max_dist is the largest distance between a position inside the grid and
+    its closest node. Positions farther away from all nodes are considered
+    to be outside of the grid.
+    """
+    node_index = dict(tree=cKDTree(pos), max_dist=max_dist)
+    return node_index
+
+
+def find_closest_node(node_index, pos):
+    """Find the node closest to a position of shape (3,).
+
+    Returns the index of the node, or -1 if the position is outside the
+    grid.
+    """
+    dist, node = node_index['tree'].query(pos)
+    if dist > node_index['max_dist']:
+        return -1
+    return int(node)
+
+
+def get_idw_weights(node_index, pos, k=8):
+    """Find the (up to) k nodes closest to a position of shape (3,), and
+    their inverse distance interpolation weights.
+
+    Returns the node indices and the weights, which sum to 1. Both are empty
+    if the position is outside the grid.
+    """
+    dist, nodes = node_index['tree'].query(
+        pos, k=k, distance_upper_bound=2 * node_index['max_dist'])
+    valid = np.isfinite(dist)
+    dist, nodes = dist[valid], nodes[valid]
+
+    if len(nodes) == 0 or dist[0] > node_index['max_dist']:
+        return np.array([], dtype=np.int64), np.array([])
+    if dist[0] < 1e-9:  # Right on a node.
+        return nodes[:1], np.array([1.])
+
+    weights = 1 / dist ** 2
+    weights /= weights.sum()
+    return nodes, weights
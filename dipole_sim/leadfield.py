@@ -0,0 +1,241 @@
+import json
+import os
+import shutil
+import numpy as np
+
+from grid import get_grid_node_pos, create_node_index
+
+
+# Bump this whenever the on-disk layout of the leadfield store changes.
+# Version 2 added the grid description to the header.
+LEADFIELD_STORE_VERSION = 2
+
+
+def get_leadfield_store_path(fwd_path, subject):
+    return fwd_path / f'{subject}-leadfield'
+
+
+def leadfield_store_exists(fwd_path, subject):
+    store_path = get_leadfield_store_path(fwd_path=fwd_path, subject=subject)
+    return (store_path / 'header.json').exists()
+
+
+def _write_json_atomic(fname, data):
+    # Write to a temporary file first, so a crash can never leave a truncated
+    # file behind.
+    tmp_fname = fname.with_name(fname.name + '.tmp')
+    with open(tmp_fname, 'w', encoding='utf-8') as f:
+        json.dump(data, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_fname, fname)
+
+
+def open_leadfield_store_for_writing(fwd_path, subject, n_points, ch_names,
+                                     overwrite=False, resume=False):
+    """Create a packed leadfield store to be filled incrementally.
+
+    Leadfields can then be written into the memory-mapped
+    ``store['leadfield']`` array of shape ``n_points x n_channels x 3``
+    without keeping all of them in memory. Call finalize_leadfield_store()
+    once all rows have been written.
+
+    The store is written into a separate directory first, and only moved
+    into place upon finalization, so an existing store remains usable (and
+    readable) in the meantime. If resume is True and an unfinished store of
+    the same shape exists, it is re-opened instead of being started from
+    scratch.
+    """
+    store_path = get_leadfield_store_path(fwd_path=fwd_path, subject=subject)
+    if (store_path / 'header.json').exists() and not overwrite:
+        raise FileExistsError(f'Leadfield store already exists: {store_path}')
+
+    partial_path = store_path.with_name(store_path.name + '-partial')
+    partial_path.mkdir(parents=True, exist_ok=True)
+    leadfield_fname = partial_path / 'leadfield.npy'
+    shape = (n_points, len(ch_names), 3)
+
+    leadfield = None
+    if resume and leadfield_fname.exists():
+        leadfield = np.load(leadfield_fname, mmap_mode='r+')
+        if leadfield.shape != shape or leadfield.dtype != np.float32:
+            leadfield = None
+
+    if leadfield is None:
+        (partial_path / 'progress.json').unlink(missing_ok=True)
+        leadfield = np.lib.format.open_memmap(leadfield_fname, mode='w+',
+                                              dtype=np.float32, shape=shape)
+
+    store = dict(path=partial_path, final_path=store_path, subject=subject,
+                 ch_names=list(ch_names), leadfield=leadfield)
+    return store
+
+
+def read_store_progress(store):
+    """Read the progress record of an unfinished store, or None.
+    """
+    progress_fname = store['path'] / 'progress.json'
+    if not progress_fname.exists():
+        return None
+
+    with open(progress_fname, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def write_store_progress(store, progress):
+    """Durably record the progress of writing an unfinished store.
+
+    All leadfields written so far are flushed to disk before the progress
+    record is updated, so the record never claims more than has been
+    written.
+    """
+    store['leadfield'].flush()
+    _write_json_atomic(store['path'] / 'progress.json', progress)
+
+
+def finalize_leadfield_store(store, pos, grid_info=None):
+    """Complete a store created via open_leadfield_store_for_writing().
+
+    pos are the dipole positions of all rows, in meters (MNE Head
+    coordinates). grid_info describes the grid the positions are nodes of;
+    by default, the regular grid described by the forward solution lookup
+    table. The completed store replaces any existing one.
+    """
+    pos = np.asarray(pos, dtype=np.float64)
+    if pos.shape != (len(store['leadfield']), 3):
+        raise ValueError(f'pos must be of shape '
+                         f'({len(store["leadfield"])}, 3), but got '
+                         f'{pos.shape}')
+
+    if grid_info is None:
+        grid_info = dict(type='regular')
+
+    store['leadfield'].flush()
+    np.save(store['path'] / 'pos.npy', pos)
+    (store['path'] / 'progress.json').unlink(missing_ok=True)
+
+    header = dict(version=LEADFIELD_STORE_VERSION,
+                  subject=store['subject'],
+                  n_points=len(pos),
+                  n_channels=len(store['ch_names']),
+                  ch_names=store['ch_names'],
+                  dtype='float32',
+                  coord_frame='head',
+                  unit='m',
+                  grid=grid_info)
+
+    # Write the header last: its presence marks the store as complete.
+    _write_json_atomic(store['path'] / 'header.json', header)
+
+    # Swap the new store into place.
+    final_path = store['final_path']
+    if final_path.exists():
+        old_path = final_path.with_name(final_path.name + '-old')
+        if old_path.exists():
+            shutil.rmtree(old_path)
+        os.replace(final_path, old_path)
+        os.replace(store['path'], final_path)
+        shutil.rmtree(old_path)
+    else:
+        os.replace(store['path'], final_path)
+
+    store['path'] = final_path
+
+
+def write_leadfield_store(fwd_path, subject, pos, leadfield, ch_names,
+                          grid_info=None, overwrite=False):
+    """Write a packed leadfield store.
+
+    The store is a directory containing one contiguous
+    ``n_points x n_channels x 3`` float32 array of "free" orientation
+    leadfields, the corresponding dipole positions (in meters, MNE Head
+    coordinates), and a small JSON header. Leadfields are expected to be
+    passed in grid order (see ``grid.create_fwd_index()``), unless grid_info
+    describes an adaptive grid (see ``grid.create_adaptive_grid()``).
+    """
+    pos = np.asarray(pos, dtype=np.float64)
+
+    if pos.ndim != 2 or pos.shape[1] != 3:
+        raise ValueError('pos must be of shape (n_points, 3)')
+    if np.shape(leadfield) != (len(pos), len(ch_names), 3):
+        raise ValueError(f'leadfield must be of shape '
+                         f'({len(pos)}, {len(ch_names)}, 3), but got '
+                         f'{np.shape(leadfield)}')
+
+    store = open_leadfield_store_for_writing(fwd_path=fwd_path,
+                                             subject=subject,
+                                             n_points=len(pos),
+                                             ch_names=ch_names,
+                                             overwrite=overwrite)
+    store['leadfield'][:] = leadfield
+    finalize_leadfield_store(store=store, pos=pos, grid_info=grid_info)
+
+
+def read_leadfield_store(fwd_path, subject, ch_names=None):
+    """Open a packed leadfield store.
+
+    The leadfield array is memory-mapped read-only, so only the pages that
+    are actually accessed will be read from disk, and all processes on the
+    same host that open the store share the same pages in the OS page cache.
+
+    If ``ch_names`` is passed, ensure the store was generated for exactly
+    these channels, in this order.
+    """
+    store_path = get_leadfield_store_path(fwd_path=fwd_path, subject=subject)
+
+    with open(store_path / 'header.json', 'r', encoding='utf-8') as f:
+        header = json.load(f)
+
+    if header['version'] == 1:
+        # Version 1 stores always used the regular grid.
+        header['grid'] = dict(type='regular')
+    elif header['version'] != LEADFIELD_STORE_VERSION:
+        raise RuntimeError(f'Unsupported leadfield store version '
+                           f'{header["version"]}, expected '
+                           f'{LEADFIELD_STORE_VERSION}. Please regenerate '
+                           f'the store: {store_path}')
+
+    if ch_names is not None and header['ch_names'] != list(ch_names):
+        raise RuntimeError(f'The channels in the leadfield store do not '
+                           f'match the channels of the data: {store_path}')
+
+    leadfield = np.load(store_path / 'leadfield.npy', mmap_mode='r')
+    pos = np.load(store_path / 'pos.npy')
+
+    store = dict(header=header, leadfield=leadfield, pos=pos)
+    return store
+
+
+def is_adaptive_store(store):
+    return store['header']['grid']['type'] == 'adaptive'
+
+
+def create_store_node_index(store):
+    """Create a spatial index of the nodes of an adaptive grid store.
+    """
+    # Every position inside the grid is at most half a diagonal of a coarse
+    # grid cell away from its closest node.
+    max_dist = store['header']['grid']['coarse_spacing'] * np.sqrt(3) / 2
+    return create_node_index(pos=store['pos'], max_dist=max_dist)
+
+
+def check_leadfield_store(store, grid, fwd_index):
+    """Ensure the rows of the store match the grid nodes in fwd_index.
+    """
+    ijk = np.argwhere(fwd_index >= 0)
+    ijk = ijk[np.argsort(fwd_index[fwd_index >= 0])]
+
+    if (len(ijk) != len(store['pos']) or
+            not np.allclose(get_grid_node_pos(grid, ijk), store['pos'],
+                            atol=5e-4)):
+        raise RuntimeError('The leadfield store does not match the forward '
+                           'solution lookup table.')
+
+
+def get_leadfield(store, row):
+    """Retrieve the "free" orientation leadfield stored in a row.
+
+    Returns a read-only ``n_channels x 3`` view into the memory-mapped
+    store.
+    """
+    return store['leadfield'][row]
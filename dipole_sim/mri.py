@@ -0,0 +1,166 @@
+import json
+import os
+import numpy as np
+import nibabel as nib
+
+
+def _to_uint8(data):
+    if data.dtype == np.uint8:
+        return data
+    return np.clip(data, 0, 255).astype(np.uint8)
+
+
+def _gen_volume(data, affine):
+    # Voxel centers along each axis, in mm.
+    vox_grid = np.c_[np.arange(data.shape[0]),
+                     np.arange(data.shape[1]),
+                     np.arange(data.shape[2])]
+    coords_mm = nib.affines.apply_affine(affine, pts=vox_grid)
+
+    volume = dict(data=data,
+                  affine=affine,
+                  coords=dict(x=coords_mm[:, 0],
+                              y=coords_mm[:, 1],
+                              z=coords_mm[:, 2]))
+    return volume
+
+
+def _get_source_stat(img):
+    # Size and modification time of the image file, if it was read from one.
+    fname = img.get_filename()
+    if fname is None:
+        return None, None
+    try:
+        stat = os.stat(fname)
+    except OSError:
+        return None, None
+    return stat.st_size, stat.st_mtime_ns
+
+
+def _read_cached_volume(cache_fname, img):
+    header_fname = cache_fname.with_suffix('.json')
+    if not (cache_fname.exists() and header_fname.exists()):
+        return None
+
+    with open(header_fname, 'r', encoding='utf-8') as f:
+        header = json.load(f)
+
+    # Only use the cache if it was generated from this very image: the file
+    # may have been replaced by one of the same shape, e.g. after re-running
+    # recon-all.
+    source_size, source_mtime = _get_source_stat(img)
+    if (header['source_shape'] != [int(n) for n in img.shape[:3]] or
+            not np.allclose(header['source_affine'], img.affine) or
+            header.get('source_size') != source_size or
+            header.get('source_mtime') != source_mtime):
+        return None
+
+    data = np.load(cache_fname, mmap_mode='r')
+    return _gen_volume(data=data, affine=np.array(header['affine']))
+
+
+def _write_atomic(fname, write):
+    # Other kernels may have the file memory-mapped, so it must never be
+    # modified in place: write to a temporary file (unique to this process,
+    # as several may write at once), and replace the old file with it.
+    tmp_fname = fname.with_name(f'{fname.name}.{os.getpid()}.tmp')
+    try:
+        with open(tmp_fname, 'wb') as f:
+            write(f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_fname, fname)
+    finally:
+        if tmp_fname.exists():
+            tmp_fname.unlink()
+
+
+def _write_cached_volume(cache_fname, img, volume):
+    source_size, source_mtime = _get_source_stat(img)
+    header = dict(source_shape=[int(n) for n in img.shape[:3]],
+                  source_affine=img.affine.tolist(),
+                  source_size=source_size,
+                  source_mtime=source_mtime,
+                  affine=volume['affine'].tolist())
+    try:
+        # The header last, as it's what marks the cache as valid for img.
+        _write_atomic(cache_fname,
+                      lambda f: np.save(f, volume['data']))
+        _write_atomic(cache_fname.with_suffix('.json'),
+                      lambda f: f.write(json.dumps(header).encode('utf-8')))
+    except OSError as e:
+        # E.g., a read-only data directory. The cache is merely an
+        # optimization, so carry on.
+        print(f'Could not cache the MR image: {e}')
+
+
+def load_mr_volume(img, cache_fname=None):
+    """Load an MR image into memory, reoriented to RAS+ ("canonical").
+
+    The (possibly compressed) image data is read and decompressed exactly
+    once, and stored as a C-contiguous uint8 array alongside the voxel
+    coordinates (in mm) along each axis.
+
+    If cache_fname (a .npy file) is passed, the prepared volume is written
+    there, and memory-mapped from there on subsequent calls.
+    """
+    if cache_fname is not None:
+        volume = _read_cached_volume(cache_fname=cache_fname, img=img)
+        if volume is not None:
+            return volume
+
+    # This is what nib.as_closest_canonical() does, but we convert to uint8
+    # before reorienting, and don't keep any other copies of the data.
+    ornt = nib.orientations.io_orientation(img.affine)
+    data = _to_uint8(np.asanyarray(img.dataobj))
+    data = nib.orientations.apply_orientation(data, ornt)
+    data = np.ascontiguousarray(data)
+    affine = img.affine @ nib.orientations.inv_ornt_aff(ornt, img.shape)
+
+    volume = _gen_volume(data=data, affine=affine)
+
+    if cache_fname is not None:
+        _write_cached_volume(cache_fname=cache_fname, img=img, volume=volume)
+
+    return volume
+
+
+def _downsample_volume(volume):
+    # Average blocks of 2 x 2 x 2 voxels, dropping a trailing odd voxel.
+    data = volume['data']
+    shape = [n - n % 2 for n in data.shape]
+    data = data[:shape[0], :shape[1], :shape[2]]
+    # Sum up neighboring voxels one axis at a time, so the largest temporary
+    # array is only a quarter of the size of the (uint8) input. The sum of
+    # 8 voxels fits into uint16.
+    data = np.add(data[0::2], data[1::2], dtype=np.uint16)
+    data = data[:, 0::2] + data[:, 1::2]
+    data = data[:, :, 0::2] + data[:, :, 1::2]
+    data = ((data + 4) // 8).astype(np.uint8)  # Round to nearest.
+
+    coords = dict()
+    for axis, n in zip(('x', 'y', 'z'), shape):
+        axis_coords = volume['coords'][axis]
+        coords[axis] = (axis_coords[0:n:2] + axis_coords[1:n:2]) / 2
+
+    # Voxel i of the new level is centered between voxels 2i and 2i + 1.
+    scale = np.diag([2., 2., 2., 1.])
+    scale[:3, 3] = 0.5
+    downsampled = dict(data=np.ascontiguousarray(data),
+                       affine=volume['affine'] @ scale,
+                       coords=coords)
+    return downsampled
+
+
+def create_mr_pyramid(volume, n_levels=3):
+    """Create a multi-resolution pyramid of an MR volume.
+
+    Level 0 is the volume itself; each subsequent level halves the
+    resolution along every axis.
+    """
+    levels = [volume]
+    for _ in range(n_levels - 1):
+        levels.append(_downsample_volume(levels[-1]))
+
+    pyramid = dict(levels=levels)
+    return pyramid
@@ -0,0 +1,73 @@
+from functools import partial
+
+
+# Labels of the artists that are drawn on top of the MRI slices.
+OVERLAY_LABELS = ('dipole_arrow', 'dipole_pos_marker', 'dipole_ori_marker')
+
+
+def _can_blit(canvas):
+    # ipympl (like WebAgg) doesn't advertise `supports_blit`, but implements
+    # blitting by sending only a diff of the previous frame to the browser.
+    return (hasattr(canvas, 'copy_from_bbox') and
+            hasattr(canvas, 'restore_region'))
+
+
+def _get_overlays(fig):
+    ax = fig.axes[0]
+    return [child for child in ax.get_children()
+            if child.get_label() in OVERLAY_LABELS]
+
+
+def _draw_overlays(fig):
+    ax = fig.axes[0]
+    for artist in _get_overlays(fig):
+        ax.draw_artist(artist)
+
+
+def _handle_slice_draw(event, widget, axis):
+    # A full redraw just happened, which does not include the (animated)
+    # overlays. Store the result as the new background, then add the
+    # overlays on top.
+    fig = widget['fig'][axis]
+    if _can_blit(fig.canvas):
+        widget['slice_background'][axis] = fig.canvas.copy_from_bbox(fig.bbox)
+
+    _draw_overlays(fig)
+
+
+def init_overlays(widget):
+    """Prepare the slice figures for blitting the overlays.
+    """
+    widget['slice_background'] = dict.fromkeys(widget['fig'].keys())
+    for axis, fig in widget['fig'].items():
+        fig.canvas.mpl_connect('draw_event',
+                               partial(_handle_slice_draw, widget=widget,
+                                       axis=axis))
+
+
+def add_overlay(artist):
+    """Exclude an artist from full redraws; it will be blitted instead.
+    """
+    artist.set_animated(True)
+    return artist
+
+
+def redraw_overlays(widget, axes=('x', 'y', 'z')):
+    """Redraw the overlays of the slice figures.
+
+    This should be called only once per event, after all overlays have been
+    added or removed. The cached MRI slice is restored, and only the overlays
+    are drawn on top of it. If no background is available yet, we schedule a
+    single full redraw instead.
+    """
+    for axis in axes:
+        fig = widget['fig'][axis]
+        background = widget['slice_background'][axis]
+
+        if background is None or not _can_blit(fig.canvas):
+            fig.canvas.draw_idle()
+            continue
+
+        fig.canvas.restore_region(background)
+        _draw_overlays(fig)
+        fig.canvas.blit(fig.bbox)
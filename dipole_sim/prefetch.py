@@ -0,0 +1,117 @@
+import itertools
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+import numpy as np
+
+from grid import get_grid_node_pos
+from download import download_fwd_from_github, GITHUB_DATA_URL
+
+
+class FwdPrefetcher:
+    """Download pre-calculated forward solutions, in the background where
+    possible.
+
+    After a dipole has been placed, the forward solutions of the grid nodes
+    around it are downloaded in a thread pool, so subsequent nearby
+    placements can be served from disk.
+    """
+
+    def __init__(self, fwd_path, subject, grid, fwd_index, radius=1,
+                 max_workers=4, base_url=GITHUB_DATA_URL):
+        self._fwd_path = fwd_path
+        self._subject = subject
+        self._grid = grid
+        self._fwd_index = fwd_index
+        self._radius = radius
+        self._base_url = base_url
+        self._executor = ThreadPoolExecutor(max_workers=max_workers,
+                                            thread_name_prefix='prefetch')
+        # Downloads that are queued or in progress, by grid node.
+        self._pending = dict()
+        self._lock = threading.Lock()
+
+        # Visit the closest neighbors first.
+        offsets = itertools.product(range(-radius, radius + 1), repeat=3)
+        offsets = sorted(offsets, key=lambda offset: np.linalg.norm(offset))
+        self._offsets = np.array(offsets[1:], dtype=np.int64).reshape(-1, 3)
+
+    def _download(self, ijk):
+        download_fwd_from_github(fwd_path=self._fwd_path,
+                                 subject=self._subject,
+                                 dipole_pos=get_grid_node_pos(self._grid,
+                                                              ijk),
+                                 base_url=self._base_url)
+
+    def _prefetch(self, ijk):
+        try:
+            self._download(ijk)
+        except Exception:
+            pass  # We'll try again (and report errors) once it's needed.
+        finally:
+            with self._lock:
+                del self._pending[ijk]
+
+    def fetch(self, ijk):
+        """Ensure the forward solution of a grid node is on disk.
+
+        Blocks until it has been downloaded. If a prefetch of this node is
+        already in progress, we wait for it instead of starting another
+        download.
+        """
+        ijk = tuple(int(idx) for idx in ijk)
+        with self._lock:
+            future = self._pending.get(ijk)
+            if future is not None and not future.cancel():
+                owner = False
+            else:
+                # Not queued (anymore): download it in this thread, and let
+                # everybody else know.
+                future = Future()
+                future.set_running_or_notify_cancel()
+                self._pending[ijk] = future
+                owner = True
+
+        if not owner:
+            future.result()
+            # The prefetch swallows errors, so this raises them if the
+            # download failed.
+            self._download(ijk)
+            return
+
+        try:
+            self._download(ijk)
+        finally:
+            with self._lock:
+                del self._pending[ijk]
+            future.set_result(None)
+
+    def prefetch_around(self, ijk):
+        """Start downloading the forward solutions of the grid nodes around
+        a node, replacing any previously queued downloads.
+        """
+        if self._radius < 1:
+            return
+
+        shape = np.array(self._grid['shape'])
+        neighbors = np.asarray(ijk) + self._offsets
+        neighbors = neighbors[((neighbors >= 0) & (neighbors < shape))
+                              .all(axis=1)]
+        neighbors = neighbors[self._fwd_index[tuple(neighbors.T)] >= 0]
+        neighbors = [tuple(int(idx) for idx in node) for node in neighbors]
+
+        with self._lock:
+            # Downloads that haven't started yet are obsolete if they're no
+            # longer close to the dipole.
+            keep = set(neighbors)
+            for node, future in list(self._pending.items()):
+                if node not in keep and future.cancel():
+                    del self._pending[node]
+
+            for node in neighbors:
+                if node in self._pending:
+                    continue
+                self._pending[node] = self._executor.submit(self._prefetch,
+                                                            node)
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
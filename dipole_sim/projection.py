@@ -0,0 +1,124 @@
+import numpy as np
+
+from grid import snap_to_grid
+from waveform import get_n_times, get_waveform_block
+
+
+def gather_leadfields(leadfield_store, grid, fwd_index, pos):
+    """Gather the leadfields of many dipoles from the leadfield store.
+
+    pos is an array of shape (n_dipoles, 3), in meters (MNE Head
+    coordinates). Every position is snapped onto the closest grid node.
+
+    Returns an array of shape (n_valid, n_channels, 3), and a boolean mask
+    of shape (n_dipoles,) indicating which dipoles have a forward solution.
+    """
+    ijk = snap_to_grid(grid, np.asarray(pos).reshape(-1, 3))
+    rows = fwd_index[ijk[:, 0], ijk[:, 1], ijk[:, 2]]
+    valid = rows >= 0
+
+    # Fancy indexing the memory-mapped store reads all rows in one go.
+    leadfield = leadfield_store['leadfield'][rows[valid]]
+    return leadfield, valid
+
+
+def project_dipoles(leadfield, ori, amplitude):
+    """Forward-project many dipoles at once.
+
+    Parameters
+    ----------
+    leadfield : array, shape (n_dipoles, n_channels, 3) | (n_channels, 3)
+        The "free" orientation leadfields. A single leadfield is used for all
+        dipoles, e.g. to sweep the orientation around a fixed origin.
+    ori : array, shape (n_dipoles, 3)
+        The dipole orientations. Need not be normalized.
+    amplitude : array, shape (n_dipoles,) | (n_dipoles, n_times)
+        The dipole amplitudes (in Am), or their time courses.
+
+    Returns
+    -------
+    data : array, shape (n_channels, n_dipoles) | (n_channels, n_times)
+        The sensor data of each individual dipole if scalar amplitudes were
+        passed; otherwise, the sensor time courses generated by all dipoles
+        together.
+    """
+    ori = np.asarray(ori, dtype=np.float64).reshape(-1, 3)
+    ori = ori / np.linalg.norm(ori, axis=1, keepdims=True)
+    amplitude = np.asarray(amplitude, dtype=np.float64)
+
+    # Collapse the three "free" orientation dimensions of each leadfield into
+    # a single "fixed" orientation dimension.
+    if leadfield.ndim == 2:
+        leadfield_fixed = ori @ leadfield.T
+    else:
+        leadfield_fixed = np.einsum('ncd,nd->nc', leadfield, ori)
+
+    # leadfield_fixed now has shape (n_dipoles, n_channels).
+    if amplitude.ndim == 1:
+        data = (leadfield_fixed * amplitude[:, np.newaxis]).T
+    else:
+        data = leadfield_fixed.T @ amplitude
+
+    return data
+
+
+def project_dipoles_from_store(leadfield_store, grid, fwd_index, pos, ori,
+                               amplitude, chunk_size=10_000):
+    """Forward-project many dipoles, retrieving leadfields from the store.
+
+    Dipoles are processed in chunks to bound memory usage. Dipoles without a
+    forward solution are ignored; for scalar amplitudes, their columns in
+    the returned array are NaN.
+    """
+    pos = np.asarray(pos).reshape(-1, 3)
+    ori = np.asarray(ori).reshape(-1, 3)
+    amplitude = np.asarray(amplitude, dtype=np.float64)
+    n_dipoles = len(pos)
+    n_channels = leadfield_store['leadfield'].shape[1]
+
+    if amplitude.ndim == 1:
+        data = np.full((n_channels, n_dipoles), fill_value=np.nan)
+    else:
+        data = np.zeros((n_channels, amplitude.shape[1]))
+
+    for start in range(0, n_dipoles, chunk_size):
+        chunk = slice(start, start + chunk_size)
+        leadfield, valid = gather_leadfields(leadfield_store=leadfield_store,
+                                             grid=grid, fwd_index=fwd_index,
+                                             pos=pos[chunk])
+        if not valid.any():
+            continue
+
+        chunk_data = project_dipoles(leadfield=leadfield,
+                                     ori=ori[chunk][valid],
+                                     amplitude=amplitude[chunk][valid])
+        if amplitude.ndim == 1:
+            data[:, np.arange(start, start + len(valid))[valid]] = chunk_data
+        else:
+            data += chunk_data
+
+    return data
+
+
+def iter_projected_time_courses(leadfield_fixed, waveform, times=None,
+                                block_size=1000):
+    """Forward-project dipole time courses, one block of samples at a time.
+
+    leadfield_fixed, of shape (n_channels, n_dipoles), holds the sensor data
+    of each dipole at 1 Am. See waveform.get_waveform_block() for the
+    waveform; times are only required if it is a function.
+
+    Yields arrays of shape (n_channels, block_size) (the last one may be
+    shorter): the sensor time courses generated by all dipoles together.
+    The full n_channels x n_times array is never materialized.
+    """
+    n_times = get_n_times(waveform=waveform, times=times)
+    n_dipoles = leadfield_fixed.shape[1]
+    for start in range(0, n_times, block_size):
+        stop = min(start + block_size, n_times)
+        block = get_waveform_block(waveform=waveform, times=times,
+                                   start=start, stop=stop,
+                                   n_dipoles=n_dipoles)
+        # For a single dipole, this is the outer product of its leadfield
+        # (in the direction of its orientation) and its waveform.
+        yield leadfield_fixed @ block
@@ -0,0 +1,251 @@
+import multiprocessing
+import pathlib
+import threading
+import time
+import traceback
+from multiprocessing.connection import Listener, Client
+import numpy as np
+
+from simulator import Simulator, compute_time_course, iter_time_course
+from mri import load_mr_volume
+
+
+DEFAULT_ADDRESS = ('localhost', 6457)
+
+# Only these methods of the Simulator can be called by clients.
+_SIMULATOR_METHODS = ('get_leadfield', 'compute_field', 'compute_fields',
+                      'get_forward_engine')
+
+
+def _handle_request(simulator, request):
+    method, kwargs = request
+    if method == 'get_state':
+        return dict(geometry=simulator.geometry,
+                    forward_engine_ready=simulator.forward_engine_ready)
+    if method not in _SIMULATOR_METHODS:
+        raise ValueError(f'Unknown method: {method}')
+
+    # The Simulator is thread-safe, so a slow request (e.g., setting up the
+    # forward engine, or a download) doesn't hold up those of other clients.
+    result = getattr(simulator, method)(**kwargs)
+
+    if method == 'get_forward_engine':
+        return None  # The engine itself stays here.
+    if result is not None:
+        # Don't send views of the memory-mapped store.
+        result = np.array(result)
+    return result
+
+
+def _serve_client(conn, simulator):
+    with conn:
+        while True:
+            try:
+                request = conn.recv()
+            except (EOFError, OSError):
+                return  # The client has gone away.
+
+            try:
+                response = ('ok', _handle_request(simulator=simulator,
+                                                  request=request))
+            except Exception as e:
+                response = ('error', type(e).__name__, str(e),
+                            traceback.format_exc())
+
+            try:
+                conn.send(response)
+            except OSError:
+                return
+
+
+def serve(info, trans, t1_img, authkey, address=DEFAULT_ADDRESS,
+          subject='sample', data_path='data', cache_mr_image=True,
+          **simulator_kwargs):
+    """Serve simulations to many Apps from a single process.
+
+    The leadfield store, lookup table, leadfield cache, and (for exact
+    solutions) the BEM and forward engine are held only once here, and
+    shared by all clients, see SimulatorClient. If cache_mr_image is True,
+    the prepared MR image is written to the cache, from where the Apps
+    memory-map it, so all of them share the same pages of memory, too.
+
+    Requests are pickled, so only trusted clients must be able to connect:
+    authkey is required. Runs until the process is terminated.
+    """
+    simulator = Simulator(info=info, trans=trans, t1_img=t1_img,
+                          subject=subject, data_path=data_path,
+                          **simulator_kwargs)
+    if cache_mr_image:
+        cache_fname = (pathlib.Path(data_path) / 'subjects' / subject /
+                       'mri' / 'T1-canonical.npy')
+        load_mr_volume(t1_img, cache_fname=cache_fname)
+
+    with Listener(address, authkey=authkey) as listener:
+        print(f'Serving simulations on {listener.address}')
+        while True:
+            try:
+                conn = listener.accept()
+            except (OSError, multiprocessing.AuthenticationError) as e:
+                print(f'Rejected a connection: {e}')
+                continue
+
+            threading.Thread(target=_serve_client,
+                             args=(conn, simulator),
+                             daemon=True).start()
+
+
+def start_server_process(info, trans, t1_img, authkey,
+                         address=DEFAULT_ADDRESS, **kwargs):
+    """Run serve() in a separate, local process, e.g. for testing.
+
+    Returns the multiprocessing.Process; terminate() it when done.
+    """
+    # Forking a process with running threads (like a Jupyter kernel) isn't
+    # safe.
+    ctx = multiprocessing.get_context('spawn')
+    process = ctx.Process(target=serve,
+                          kwargs=dict(info=info, trans=trans, t1_img=t1_img,
+                                      authkey=authkey, address=address,
+                                      **kwargs),
+                          daemon=True)
+    process.start()
+    return process
+
+
+class SimulatorClient:
+    """Run simulations in a server process, see serve().
+
+    This mimics the Simulator, so it can be passed to the App instead of
+    one. exact_solution and interpolation are kept per client.
+    """
+
+    def __init__(self, authkey, address=DEFAULT_ADDRESS,
+                 exact_solution=False, interpolation='nearest', timeout=60):
+        self.exact_solution = exact_solution
+        self.interpolation = interpolation
+
+        # The server may still be starting up.
+        deadline = time.monotonic() + timeout
+        while True:
+            try:
+                self._conn = Client(address, authkey=authkey)
+                break
+            except (ConnectionRefusedError, FileNotFoundError):
+                if time.monotonic() > deadline:
+                    raise RuntimeError(f'Could not connect to the simulation '
+                                       f'server at {address}')
+                time.sleep(0.2)
+
+        # The evaluation runs in a worker thread, but a connection must only
+        # be used by one thread at a time.
+        self._lock = threading.Lock()
+        state = self._request('get_state')
+        self.geometry = state['geometry']
+        self._forward_engine_ready = state['forward_engine_ready']
+
+    def _request(self, method, **kwargs):
+        with self._lock:
+            self._conn.send((method, kwargs))
+            response = self._conn.recv()
+
+        if response[0] == 'error':
+            _, exc_type, msg, tb = response
+            raise RuntimeError(f'The simulation server failed with '
+                               f'{exc_type}: {msg}\n\n{tb}')
+        return response[1]
+
+    @property
+    def forward_engine_ready(self):
+        return self._forward_engine_ready
+
+    def get_forward_engine(self):
+        """Make the server set up the engine for exact forward calculations.
+        """
+        self._request('get_forward_engine')
+        self._forward_engine_ready = True
+
+    def get_leadfield(self, pos, exact_solution=None, interpolation=None):
+        exact_solution, interpolation = self._get_defaults(exact_solution,
+                                                           interpolation)
+        return self._request('get_leadfield', pos=pos,
+                             exact_solution=exact_solution,
+                             interpolation=interpolation)
+
+    def compute_field(self, pos, ori, amplitude=1., exact_solution=None,
+                      interpolation=None):
+        exact_solution, interpolation = self._get_defaults(exact_solution,
+                                                           interpolation)
+        meeg_data = self._request('compute_field', pos=pos, ori=ori,
+                                  amplitude=amplitude,
+                                  exact_solution=exact_solution,
+                                  interpolation=interpolation)
+        if exact_solution:
+            self._forward_engine_ready = True
+        return meeg_data
+
+    def compute_fields(self, pos, ori, amplitude=1., exact_solution=None,
+                       interpolation=None):
+        exact_solution, interpolation = self._get_defaults(exact_solution,
+                                                           interpolation)
+        data = self._request('compute_fields', pos=pos, ori=ori,
+                             amplitude=amplitude,
+                             exact_solution=exact_solution,
+                             interpolation=interpolation)
+        if exact_solution:
+            self._forward_engine_ready = True
+        return data
+
+    def compute_time_course(self, pos, ori, waveform, times=None,
+                            exact_solution=None, interpolation=None):
+        # Only the leadfields are retrieved from the server; the waveforms
+        # (which may be functions) are evaluated here.
+        return compute_time_course(
+            simulator=self, pos=pos, ori=ori, waveform=waveform, times=times,
+            exact_solution=exact_solution, interpolation=interpolation)
+
+    def iter_time_course(self, pos, ori, waveform, times=None,
+                         block_size=1000, exact_solution=None,
+                         interpolation=None):
+        return iter_time_course(
+            simulator=self, pos=pos, ori=ori, waveform=waveform, times=times,
+            block_size=block_size, exact_solution=exact_solution,
+            interpolation=interpolation)
+
+    def _get_defaults(self, exact_solution, interpolation):
+        if exact_solution is None:
+            exact_solution = self.exact_solution
+        if interpolation is None:
+            interpolation = self.interpolation
+        return exact_solution, interpolation
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+    def shutdown(self):
+        self.close()
+
+
+if __name__ == '__main__':
+    import os
+    import mne
+    import nibabel as nib
+
+    # Clients must use the same key.
+    authkey = os.environ['DIPOLE_SIM_AUTHKEY'].encode()
+
+    data_path = pathlib.Path('data')
+    subject = 'sample'
+
+    evoked_fname = data_path / 'sample-ave.fif'
+    evoked = mne.read_evokeds(evoked_fname, verbose='warning')[0]
+    evoked.pick_types(meg=True, eeg=True)
+    info = evoked.copy().del_proj().info
+    info['bads'] = []
+
+    t1_img = nib.load(str(data_path / 'subjects' / subject / 'mri' /
+                          'T1.mgz'))
+    head_to_mri_t = mne.read_trans(data_path / 'sample-trans.fif')
+
+    serve(info=info, trans=head_to_mri_t, t1_img=t1_img, authkey=authkey,
+          data_path=data_path, subject=subject)
@@ -0,0 +1,644 @@
+import pathlib
+import threading
+import numpy as np
+import mne
+
+from grid import (snap_to_grid, get_grid_node_pos, create_fwd_index,
+                  get_trilinear_weights, find_closest_node, get_idw_weights)
+from transforms import gen_geometry_context, ras_to_head
+from projection import (project_dipoles, project_dipoles_from_store,
+                        iter_projected_time_courses)
+from waveform import get_n_times, get_waveform_block
+from download import (download_fwd_from_github, download_bem_from_github,
+                      GITHUB_DATA_URL)
+from forward import (load_fwd_lookup_table, create_forward_engine,
+                     check_inside_skull, compute_leadfields)
+from leadfield import (leadfield_store_exists, read_leadfield_store,
+                       check_leadfield_store, is_adaptive_store,
+                       create_store_node_index, get_leadfield)
+from cache import LRUCache
+from prefetch import FwdPrefetcher
+
+
+# None is cached, too, for positions without a forward solution.
+_NOT_CACHED = object()
+
+
+def _read_leadfield_from_fif(fwd_path, subject, dipole_ijk, dipole_pos_for_fwd,
+                             fwd_prefetcher=None):
+    fwd_fname = (f'{subject}-'
+                 f'{dipole_pos_for_fwd[0]:.3f}-'
+                 f'{dipole_pos_for_fwd[1]:.3f}-'
+                 f'{dipole_pos_for_fwd[2]:.3f}-fwd.fif')
+    if (fwd_path / fwd_fname).exists():
+        print(f'\nUsing existing forward solution: {fwd_fname}\n')
+    else:
+        print('Retrieving forward solution from GitHub.\n\n')
+        try:
+            if fwd_prefetcher is None:
+                download_fwd_from_github(fwd_path=fwd_path, subject=subject,
+                                         dipole_pos=dipole_pos_for_fwd)
+            else:
+                fwd_prefetcher.fetch(dipole_ijk)
+        except RuntimeError as e:
+            msg = (f'Failed to retrieve pre-calculated forward solution. '
+                   f'The error was: {e}\n\n'
+                   f'Please try again with another dipole origin inside '
+                   f'the brain.')
+            raise RuntimeError(msg)
+
+    fwd = mne.read_forward_solution(fwd_path / fwd_fname)
+    return fwd['sol']['data']
+
+
+def load_bem_solution(bem_path, subject, base_url=GITHUB_DATA_URL):
+    """Read the BEM solution, retrieving it from GitHub if necessary.
+    """
+    if (bem_path).exists():
+        print(f'\nUsing existing BEM solution: {bem_path}\n')
+    else:
+        print('Retrieving BEM solution from GitHub.')
+        try:
+            download_bem_from_github(data_path=bem_path.parent,
+                                     subject=subject,
+                                     overwrite=False,
+                                     base_url=base_url)
+        except RuntimeError as e:
+            msg = (f'Failed to retrieve the BEM solution. '
+                   f'The error was: {e}\n')
+            raise RuntimeError(msg)
+    bem = mne.read_bem_solution(bem_path, verbose=False)
+    return bem
+
+
+def _compute_exact_leadfield(dipole_pos, forward_engine):
+    if not check_inside_skull(engine=forward_engine, pos=dipole_pos)[0]:
+        return None
+
+    leadfield = compute_leadfields(engine=forward_engine, pos=dipole_pos)[0]
+    return leadfield
+
+
+def _retrieve_grid_leadfield(dipole_ijk, fwd_path, subject, geometry,
+                             fwd_index, leadfield_store, leadfield_cache,
+                             fwd_prefetcher=None, verbose=True):
+    # Pre-calculated solutions are cached per grid node.
+    dipole_ijk = tuple(int(idx) for idx in dipole_ijk)
+    cache_key = ('grid',) + dipole_ijk
+    if leadfield_cache is not None:
+        leadfield = leadfield_cache.get(cache_key, _NOT_CACHED)
+        if leadfield is not _NOT_CACHED:
+            if verbose:
+                print('\nUsing cached forward solution.\n')
+            return leadfield
+
+    fwd_row = fwd_index[dipole_ijk]
+    if fwd_row < 0:
+        leadfield = None  # This result is cached, too.
+    elif leadfield_store is not None:
+        if verbose:
+            print('\nUsing packed leadfield store.\n')
+        # This is a view into the memory-mapped store; no data is copied.
+        leadfield = get_leadfield(store=leadfield_store, row=fwd_row)
+    else:
+        dipole_pos_for_fwd = get_grid_node_pos(geometry['grid'], dipole_ijk)
+        leadfield = _read_leadfield_from_fif(
+            fwd_path=fwd_path, subject=subject, dipole_ijk=dipole_ijk,
+            dipole_pos_for_fwd=dipole_pos_for_fwd,
+            fwd_prefetcher=fwd_prefetcher)
+
+    if leadfield is not None:
+        leadfield.setflags(write=False)
+
+    if leadfield_cache is not None:
+        leadfield_cache.put(cache_key, leadfield)
+
+    return leadfield
+
+
+def _interpolate_grid_leadfield(dipole_pos, fwd_path, subject, geometry,
+                                fwd_index, leadfield_store, leadfield_cache,
+                                fwd_prefetcher=None):
+    # Blend the leadfields of the surrounding grid nodes. Near the inner
+    # skull, some of these nodes have no forward solution; we simply leave
+    # them out and re-normalize the weights of the remaining ones.
+    ijk, weights = get_trilinear_weights(geometry['grid'], dipole_pos[0])
+
+    leadfield = None
+    weights_sum = 0.
+    n_nodes = 0
+    for node_ijk, weight in zip(ijk, weights):
+        if weight == 0 or fwd_index[tuple(node_ijk)] < 0:
+            continue
+
+        node_leadfield = _retrieve_grid_leadfield(
+            dipole_ijk=node_ijk, fwd_path=fwd_path, subject=subject,
+            geometry=geometry, fwd_index=fwd_index,
+            leadfield_store=leadfield_store, leadfield_cache=leadfield_cache,
+            fwd_prefetcher=fwd_prefetcher, verbose=False)
+        if leadfield is None:
+            leadfield = weight * node_leadfield
+        else:
+            leadfield += weight * node_leadfield
+        weights_sum += weight
+        n_nodes += 1
+
+    if leadfield is None:
+        return None
+
+    print(f'Requested calculations for dipole located at:\n'
+          f'    x={dipole_pos[0, 0]}, y={dipole_pos[0, 1]}, '
+          f'z={dipole_pos[0, 2]} [m, MNE Head]\n'
+          f'Interpolating the forward solutions of {n_nodes} surrounding '
+          f'grid nodes.')
+
+    leadfield /= weights_sum
+    leadfield.setflags(write=False)
+    return leadfield
+
+
+def _retrieve_node_leadfield(node, leadfield_store, leadfield_cache):
+    # Nodes of adaptive grids are cached by their row in the store.
+    cache_key = ('node', int(node))
+    if leadfield_cache is not None:
+        leadfield = leadfield_cache.get(cache_key, _NOT_CACHED)
+        if leadfield is not _NOT_CACHED:
+            return leadfield
+
+    leadfield = get_leadfield(store=leadfield_store, row=node)
+    leadfield.setflags(write=False)
+
+    if leadfield_cache is not None:
+        leadfield_cache.put(cache_key, leadfield)
+
+    return leadfield
+
+
+def _retrieve_adaptive_leadfield(dipole_pos, node_index, leadfield_store,
+                                 leadfield_cache, interpolation):
+    print(f'Requested calculations for dipole located at:\n'
+          f'    x={dipole_pos[0, 0]}, y={dipole_pos[0, 1]}, '
+          f'z={dipole_pos[0, 2]} [m, MNE Head]')
+
+    if interpolation == 'nearest':
+        nodes = [find_closest_node(node_index, dipole_pos[0])]
+        weights = [1.]
+        if nodes[0] < 0:
+            return None
+    else:
+        # The nodes of adaptive grids don't form cubes, so we use inverse
+        # distance weighting instead of trilinear interpolation.
+        nodes, weights = get_idw_weights(node_index, dipole_pos[0])
+        if len(nodes) == 0:
+            return None
+
+    if len(nodes) == 1:
+        node_pos = leadfield_store['pos'][nodes[0]]
+        print(f'Using a forward solution for the following location:\n'
+              f'    x={node_pos[0]}, y={node_pos[1]}, z={node_pos[2]} '
+              f'[m, MNE Head]')
+        return _retrieve_node_leadfield(node=nodes[0],
+                                        leadfield_store=leadfield_store,
+                                        leadfield_cache=leadfield_cache)
+
+    print(f'Interpolating the forward solutions of {len(nodes)} '
+          f'surrounding grid nodes.')
+    leadfield = sum(weight * _retrieve_node_leadfield(
+                        node=node, leadfield_store=leadfield_store,
+                        leadfield_cache=leadfield_cache)
+                    for node, weight in zip(nodes, weights))
+    leadfield.setflags(write=False)
+    return leadfield
+
+
+def retrieve_leadfield(dipole_pos, fwd_path, subject, geometry,
+                       exact_solution, forward_engine=None, fwd_index=None,
+                       leadfield_store=None, leadfield_cache=None,
+                       interpolation='nearest', node_index=None,
+                       fwd_prefetcher=None):
+    """Retrieve the "free" orientation leadfield for a dipole position.
+
+    Returns an ``n_channels x 3`` array, or ``None`` if no pre-calculated
+    forward solution is available for this position (or, for exact
+    solutions, if it is outside the inner skull). Exact solutions are
+    computed via the forward_engine, see forward.create_forward_engine().
+    If a leadfield_cache is passed, leadfields are only retrieved once per
+    grid node (or per position, for exact solutions), so subsequent changes
+    of the dipole orientation or amplitude don't require any I/O.
+
+    Unless an exact solution is requested, the pre-calculated leadfield of
+    the closest grid node is used (``interpolation='nearest'``), or the
+    leadfields of the up to 8 surrounding nodes are interpolated
+    (``interpolation='trilinear'``).
+
+    If the leadfield_store is based on an adaptive grid, pass its node_index
+    (see ``leadfield.create_store_node_index()``) instead of fwd_index. For
+    these grids, we interpolate via inverse distance weighting of the 8
+    closest nodes.
+
+    Without a leadfield_store, individual forward solutions are downloaded
+    as needed, via the fwd_prefetcher if passed (see
+    ``prefetch.FwdPrefetcher``).
+    """
+    if interpolation not in ('nearest', 'trilinear'):
+        raise ValueError(f'interpolation must be "nearest" or "trilinear", '
+                         f'but got: {interpolation}')
+
+    if not exact_solution:
+        if node_index is not None:
+            return _retrieve_adaptive_leadfield(
+                dipole_pos=dipole_pos, node_index=node_index,
+                leadfield_store=leadfield_store,
+                leadfield_cache=leadfield_cache, interpolation=interpolation)
+
+        if interpolation == 'trilinear':
+            return _interpolate_grid_leadfield(
+                dipole_pos=dipole_pos, fwd_path=fwd_path, subject=subject,
+                geometry=geometry, fwd_index=fwd_index,
+                leadfield_store=leadfield_store,
+                leadfield_cache=leadfield_cache,
+                fwd_prefetcher=fwd_prefetcher)
+
+        # Retrieve the dipole pos closest to the one we have a pre-calculated
+        # fwd for.
+        grid = geometry['grid']
+        dipole_ijk = snap_to_grid(grid, dipole_pos[0])
+        dipole_pos_for_fwd = get_grid_node_pos(grid, dipole_ijk)
+
+        print(f'Requested calculations for dipole located at:\n'
+              f'    x={dipole_pos[0, 0]}, y={dipole_pos[0, 1]}, '
+              f'z={dipole_pos[0, 2]} [m, MNE Head]\n'
+              f'Using a forward solution for the following location:\n'
+              f'    x={dipole_pos_for_fwd[0]}, y={dipole_pos_for_fwd[1]}, '
+              f'z={dipole_pos_for_fwd[2]} [m, MNE Head]')
+
+        return _retrieve_grid_leadfield(
+            dipole_ijk=dipole_ijk, fwd_path=fwd_path, subject=subject,
+            geometry=geometry, fwd_index=fwd_index,
+            leadfield_store=leadfield_store, leadfield_cache=leadfield_cache,
+            fwd_prefetcher=fwd_prefetcher)
+
+    if forward_engine is None:
+        raise ValueError('Must provide forward_engine for exact solutions')
+
+    # Exact solutions are cached per position (in µm).
+    cache_key = ('exact',) + tuple(np.rint(dipole_pos[0] * 1e6).astype(int))
+    if leadfield_cache is not None:
+        leadfield = leadfield_cache.get(cache_key, _NOT_CACHED)
+        if leadfield is not _NOT_CACHED:
+            print('\nUsing cached forward solution.\n')
+            return leadfield
+
+    leadfield = _compute_exact_leadfield(dipole_pos=dipole_pos,
+                                         forward_engine=forward_engine)
+    if leadfield is not None:
+        leadfield.setflags(write=False)
+
+    if leadfield_cache is not None:
+        leadfield_cache.put(cache_key, leadfield)
+
+    return leadfield
+
+
+def compute_evoked_field(dipole_pos, dipole_ori, fwd_path, subject,
+                         geometry, exact_solution, forward_engine=None,
+                         fwd_index=None, leadfield_store=None,
+                         leadfield_cache=None, interpolation='nearest',
+                         node_index=None, fwd_prefetcher=None):
+    """Compute the sensor data generated by a dipole with an amplitude of
+    1 Am.
+
+    dipole_pos and dipole_ori are in MRI RAS coordinates. Returns None if
+    no forward solution is available for this dipole. No widgets are
+    touched, so this may run in a background thread.
+    """
+    if fwd_index is None and node_index is None:
+        raise ValueError('Must provide fwd_index or node_index')
+
+    dipole_pos_ras = np.array(dipole_pos).reshape(1, 3)
+    dipole_pos = ras_to_head(geometry=geometry, pts=dipole_pos_ras)
+
+    dipole_ori_ras = np.array(dipole_ori).reshape(1, 3)
+    dipole_ori = ras_to_head(geometry=geometry, pts=dipole_ori_ras,
+                             move=False)
+    dipole_ori /= np.linalg.norm(dipole_ori)
+
+    leadfield = retrieve_leadfield(dipole_pos=dipole_pos, fwd_path=fwd_path,
+                                   subject=subject, geometry=geometry,
+                                   exact_solution=exact_solution,
+                                   forward_engine=forward_engine,
+                                   fwd_index=fwd_index,
+                                   leadfield_store=leadfield_store,
+                                   leadfield_cache=leadfield_cache,
+                                   interpolation=interpolation,
+                                   node_index=node_index,
+                                   fwd_prefetcher=fwd_prefetcher)
+
+    if fwd_prefetcher is not None and not exact_solution:
+        # The user is likely to place the next dipole close to this one.
+        fwd_prefetcher.prefetch_around(snap_to_grid(geometry['grid'],
+                                                    dipole_pos[0]))
+
+    if leadfield is None:
+        return None
+
+    meeg_data = project_dipoles(leadfield=leadfield, ori=dipole_ori,
+                                amplitude=[1.])[:, 0]
+    return meeg_data
+
+
+def _get_fixed_leadfields(simulator, pos, ori, exact_solution,
+                          interpolation):
+    # The sensor data of each dipole at 1 Am. Dipoles without a forward
+    # solution don't contribute.
+    leadfield_fixed = simulator.compute_fields(
+        pos=pos, ori=ori, amplitude=1., exact_solution=exact_solution,
+        interpolation=interpolation)
+    return np.nan_to_num(leadfield_fixed, nan=0.)
+
+
+def compute_time_course(simulator, pos, ori, waveform, times=None,
+                        exact_solution=None, interpolation=None):
+    """Compute the sensor time courses generated by dipoles, see
+    Simulator.compute_time_course().
+    """
+    # Check the waveform before retrieving the leadfields.
+    n_times = get_n_times(waveform=waveform, times=times)
+    leadfield_fixed = _get_fixed_leadfields(
+        simulator=simulator, pos=pos, ori=ori,
+        exact_solution=exact_solution, interpolation=interpolation)
+    waveforms = get_waveform_block(
+        waveform=waveform, times=times, start=0, stop=n_times,
+        n_dipoles=leadfield_fixed.shape[1])
+    return leadfield_fixed @ waveforms
+
+
+def iter_time_course(simulator, pos, ori, waveform, times=None,
+                     block_size=1000, exact_solution=None,
+                     interpolation=None):
+    """Compute the sensor time courses generated by dipoles, block by block,
+    see Simulator.iter_time_course().
+    """
+    # The waveform is checked and the leadfields are retrieved right away,
+    # not on the first iteration.
+    get_n_times(waveform=waveform, times=times)
+    leadfield_fixed = _get_fixed_leadfields(
+        simulator=simulator, pos=pos, ori=ori,
+        exact_solution=exact_solution, interpolation=interpolation)
+    return iter_projected_time_courses(leadfield_fixed=leadfield_fixed,
+                                       waveform=waveform, times=times,
+                                       block_size=block_size)
+
+
+class Simulator:
+    """Simulate the sensor data generated by dipoles.
+
+    This is the computational core of the App: it transforms MRI RAS
+    coordinates (in mm) to MNE Head coordinates, retrieves the leadfields of
+    the dipole positions, and projects the dipoles onto the sensors. All
+    inputs and outputs are arrays; as no widgets or figures are involved,
+    it can be used from scripts and worker processes as well.
+
+    Leadfields are read from the packed leadfield store if there is one in
+    data_path / 'fwd', and otherwise retrieved as individual pre-calculated
+    forward solutions. With exact_solution=True, they are computed from the
+    BEM instead; the forward engine is set up when it is first needed.
+    exact_solution and interpolation are only defaults, and can be overridden
+    for each call.
+
+    The methods may be called from several threads at once.
+    """
+
+    def __init__(self, info, trans, t1_img, subject='sample',
+                 data_path='data', exact_solution=False,
+                 interpolation='nearest', leadfield_cache_size=128,
+                 data_url=GITHUB_DATA_URL, prefetch_radius=1,
+                 prefetch_workers=4):
+        self.info = info
+        self.subject = subject
+        self.exact_solution = exact_solution
+        self.interpolation = interpolation
+
+        self._trans = trans
+        self._data_path = pathlib.Path(data_path)
+        self._fwd_path = self._data_path / 'fwd'
+        self._bem_path = self._data_path / f'{subject}-bem-sol.fif'
+        self._data_url = data_url
+
+        self.geometry = gen_geometry_context(head_to_mri_t=trans,
+                                             t1_img=t1_img, info=info)
+        self._leadfield_store = self._init_leadfield_store()
+        self._fwd_index, self._node_index = self._init_leadfield_index()
+        self._fwd_prefetcher = self._init_fwd_prefetcher(
+            radius=prefetch_radius, max_workers=prefetch_workers)
+        self._leadfield_cache = LRUCache(maxsize=leadfield_cache_size)
+
+        self._forward_engine = None
+        self._forward_engine_lock = threading.Lock()
+
+    def _init_leadfield_store(self):
+        # The packed leadfield store is optional; without it, we fall back to
+        # retrieving individual forward solutions.
+        if not leadfield_store_exists(fwd_path=self._fwd_path,
+                                      subject=self.subject):
+            return None
+
+        store = read_leadfield_store(fwd_path=self._fwd_path,
+                                     subject=self.subject,
+                                     ch_names=self.info['ch_names'])
+        return store
+
+    def _init_leadfield_index(self):
+        # Adaptive grids are indexed spatially; the regular grid is indexed
+        # via the forward solution lookup table.
+        store = self._leadfield_store
+        if store is not None and is_adaptive_store(store):
+            return None, create_store_node_index(store)
+
+        fwd_exists = load_fwd_lookup_table(fwd_path=self._fwd_path,
+                                           grid=self.geometry['grid'])
+        fwd_index = create_fwd_index(fwd_exists)
+        if store is not None:
+            check_leadfield_store(store=store, grid=self.geometry['grid'],
+                                  fwd_index=fwd_index)
+        return fwd_index, None
+
+    def _init_fwd_prefetcher(self, radius, max_workers):
+        # Individual forward solutions are only needed without a store.
+        if self._leadfield_store is not None:
+            return None
+
+        prefetcher = FwdPrefetcher(fwd_path=self._fwd_path,
+                                   subject=self.subject,
+                                   grid=self.geometry['grid'],
+                                   fwd_index=self._fwd_index,
+                                   radius=radius, max_workers=max_workers,
+                                   base_url=self._data_url)
+        return prefetcher
+
+    @property
+    def forward_engine_ready(self):
+        """Whether exact solutions can be computed without further setup.
+        """
+        return self._forward_engine is not None
+
+    def get_forward_engine(self):
+        """Set up the engine for exact forward calculations, once.
+        """
+        with self._forward_engine_lock:
+            if self._forward_engine is None:
+                bem = load_bem_solution(bem_path=self._bem_path,
+                                        subject=self.subject,
+                                        base_url=self._data_url)
+                self._forward_engine = create_forward_engine(
+                    bem=bem, info=self.info, trans=self._trans)
+        return self._forward_engine
+
+    def ras_to_head(self, pos, move=True):
+        """Transform points of shape (..., 3) from MRI RAS (mm) to MNE Head
+        (m).
+
+        Pass move=False to transform directions instead of points.
+        """
+        return ras_to_head(geometry=self.geometry, pts=pos, move=move)
+
+    def snap_to_grid(self, pos):
+        """Return the position of the grid node closest to each point of
+        shape (..., 3), all in MNE Head coordinates (m).
+        """
+        grid = self.geometry['grid']
+        pos = np.asarray(pos, dtype=np.float64)
+        ijk = snap_to_grid(grid, pos.reshape(-1, 3))
+        return get_grid_node_pos(grid, ijk).reshape(pos.shape)
+
+    def get_leadfield(self, pos, exact_solution=None, interpolation=None):
+        """Retrieve the "free" orientation leadfield for a dipole position
+        in MRI RAS coordinates (mm).
+
+        Returns an ``n_channels x 3`` array, or None if no forward solution
+        is available for this position. See retrieve_leadfield().
+        """
+        if exact_solution is None:
+            exact_solution = self.exact_solution
+        if interpolation is None:
+            interpolation = self.interpolation
+        forward_engine = self.get_forward_engine() if exact_solution else None
+
+        pos = self.ras_to_head(np.asarray(pos, dtype=np.float64).reshape(1, 3))
+        leadfield = retrieve_leadfield(
+            dipole_pos=pos, fwd_path=self._fwd_path, subject=self.subject,
+            geometry=self.geometry, exact_solution=exact_solution,
+            forward_engine=forward_engine, fwd_index=self._fwd_index,
+            leadfield_store=self._leadfield_store,
+            leadfield_cache=self._leadfield_cache,
+            interpolation=interpolation, node_index=self._node_index,
+            fwd_prefetcher=self._fwd_prefetcher)
+        return leadfield
+
+    def compute_field(self, pos, ori, amplitude=1., exact_solution=None,
+                      interpolation=None):
+        """Compute the sensor data of a single dipole.
+
+        pos and ori are in MRI RAS coordinates (mm), and the amplitude is in
+        Am. Returns an array of shape (n_channels,), or None if no forward
+        solution is available for this position.
+        """
+        if exact_solution is None:
+            exact_solution = self.exact_solution
+        if interpolation is None:
+            interpolation = self.interpolation
+        forward_engine = self.get_forward_engine() if exact_solution else None
+
+        meeg_data = compute_evoked_field(
+            dipole_pos=pos, dipole_ori=ori, fwd_path=self._fwd_path,
+            subject=self.subject, geometry=self.geometry,
+            exact_solution=exact_solution, forward_engine=forward_engine,
+            fwd_index=self._fwd_index,
+            leadfield_store=self._leadfield_store,
+            leadfield_cache=self._leadfield_cache,
+            interpolation=interpolation, node_index=self._node_index,
+            fwd_prefetcher=self._fwd_prefetcher)
+        if meeg_data is None:
+            return None
+        return meeg_data * amplitude
+
+    def compute_fields(self, pos, ori, amplitude=1., exact_solution=None,
+                       interpolation=None):
+        """Compute the sensor data of many dipoles, each on its own.
+
+        pos and ori are arrays of shape (n_dipoles, 3) in MRI RAS
+        coordinates (mm), and amplitude is a scalar or an array of shape
+        (n_dipoles,), in Am. Returns an array of shape
+        (n_channels, n_dipoles); the columns of dipoles without a forward
+        solution are NaN.
+        """
+        if exact_solution is None:
+            exact_solution = self.exact_solution
+        if interpolation is None:
+            interpolation = self.interpolation
+
+        pos = np.asarray(pos, dtype=np.float64).reshape(-1, 3)
+        ori = np.asarray(ori, dtype=np.float64).reshape(-1, 3)
+        amplitude = np.broadcast_to(np.asarray(amplitude, dtype=np.float64),
+                                    (len(pos),))
+
+        # Snapped to the regular grid, all leadfields can be read from the
+        # store in one go.
+        if (not exact_solution and self._leadfield_store is not None and
+                self._fwd_index is not None and
+                interpolation == 'nearest'):
+            return project_dipoles_from_store(
+                leadfield_store=self._leadfield_store,
+                grid=self.geometry['grid'], fwd_index=self._fwd_index,
+                pos=self.ras_to_head(pos),
+                ori=self.ras_to_head(ori, move=False),
+                amplitude=amplitude)
+
+        data = np.full((len(self.info['ch_names']), len(pos)),
+                       fill_value=np.nan)
+        for idx in range(len(pos)):
+            meeg_data = self.compute_field(pos=pos[idx], ori=ori[idx],
+                                           amplitude=amplitude[idx],
+                                           exact_solution=exact_solution,
+                                           interpolation=interpolation)
+            if meeg_data is not None:
+                data[:, idx] = meeg_data
+        return data
+
+    def compute_time_course(self, pos, ori, waveform, times=None,
+                            exact_solution=None, interpolation=None):
+        """Compute the sensor time courses generated by dipoles.
+
+        pos and ori are arrays of shape (3,) or (n_dipoles, 3) in MRI RAS
+        coordinates (mm). The waveform (in Am) is an array of shape
+        (n_times,) or (n_dipoles, n_times), or a function of times (in s),
+        e.g. functools.partial(waveform.damped_sinusoid, freq=20.); see
+        waveform.get_waveform_block(). Dipoles without a forward solution
+        are ignored.
+
+        Returns an array of shape (n_channels, n_times). For long time
+        courses, see iter_time_course().
+        """
+        return compute_time_course(
+            simulator=self, pos=pos, ori=ori, waveform=waveform, times=times,
+            exact_solution=exact_solution, interpolation=interpolation)
+
+    def iter_time_course(self, pos, ori, waveform, times=None,
+                         block_size=1000, exact_solution=None,
+                         interpolation=None):
+        """Like compute_time_course(), but yield the sensor data in blocks
+        of block_size samples.
+
+        The leadfields are only retrieved once, and the full
+        n_channels x n_times array is never materialized.
+        """
+        return iter_time_course(
+            simulator=self, pos=pos, ori=ori, waveform=waveform, times=times,
+            block_size=block_size, exact_solution=exact_solution,
+            interpolation=interpolation)
+
+    def shutdown(self):
+        """Stop the background downloads of forward solutions, if any.
+        """
+        if self._fwd_prefetcher is not None:
+            self._fwd_prefetcher.shutdown()
@@ -1,44 +1,130 @@
 import numpy as np
 import matplotlib.pyplot as plt
-import xarray as xr
 
 from forward import _create_format_coord
 
 
-def plot_slice(widget, state, axis, pos, img_data):
+# How long to wait after the last slice change before replacing a coarse
+# preview with the full-resolution slice.
+FULL_RES_DELAY_MS = 300
+
+# A level may be stretched by up to this factor to fill the figure: MR
+# images are blurry anyway, so this is hardly noticeable, while the next
+# finer level would have four times as many pixels to encode and send.
+PYRAMID_LEVEL_MAX_ZOOM = 1.5
+
+
+def _get_slice_idx(img_data, axis, pos):
+    """Find the index of the slice closest to pos (in mm) along an axis.
+    """
+    coords = img_data['coords'][axis]
+    step = (coords[-1] - coords[0]) / (len(coords) - 1)
+    idx = int(np.rint((pos - coords[0]) / step))
+    return min(max(idx, 0), len(coords) - 1)
+
+
+def _get_slice_extent(img_data, x_axis, y_axis):
+    # Voxel centers are at the coordinates, so extend by half a voxel.
+    extent = []
+    for axis in (x_axis, y_axis):
+        coords = img_data['coords'][axis]
+        half_step = (coords[-1] - coords[0]) / (len(coords) - 1) / 2
+        extent.extend([coords[0] - half_step, coords[-1] + half_step])
+    return extent
+
+
+def _select_pyramid_level(img_data, fig, x_axis, y_axis,
+                          max_zoom=PYRAMID_LEVEL_MAX_ZOOM):
+    """Select the coarsest level that has at least one voxel per max_zoom
+    screen pixels.
+
+    E.g., the axes of a 2 x 2 inch figure at 100 dpi are about 155 pixels
+    wide, so a 256 x 256 slice is drawn from the 128 x 128 level.
+    """
+    bbox = fig.axes[0].get_window_extent()
+    levels = img_data['levels']
+    for level in range(len(levels) - 1, 0, -1):
+        coords = levels[level]['coords']
+        if (len(coords[x_axis]) * max_zoom >= bbox.width and
+                len(coords[y_axis]) * max_zoom >= bbox.height):
+            return level
+    return 0
+
+
+def _cancel_full_res(widget, axis):
+    timer = widget['slice_timer'][axis]
+    if timer is not None:
+        timer.stop()
+        widget['slice_timer'][axis] = None
+
+
+def _schedule_full_res(widget, state, axis, pos, img_data):
+    timer = widget['fig'][axis].canvas.new_timer(interval=FULL_RES_DELAY_MS)
+    timer.single_shot = True
+    timer.add_callback(plot_slice, widget=widget, state=state, axis=axis,
+                       pos=pos, img_data=img_data, defer_full_res=False)
+    timer.start()
+    widget['slice_timer'][axis] = timer
+
+
+def plot_slice(widget, state, axis, pos, img_data, defer_full_res=None):
+    """Plot an MRI slice.
+
+    img_data is a pyramid as returned by mri.create_mr_pyramid(). The level
+    is selected based on the size of the figure. If defer_full_res is True,
+    an even coarser preview is drawn first, and the selected level only once
+    no other slice has been requested for a moment. None means to use the
+    setting stored in the widget.
+    """
     if axis == 'x':
-        coord = dict(x=pos)  # Used for xarray slicing below
         x_axis = 'y'
         y_axis = 'z'
     elif axis == 'y':
-        coord = dict(y=pos)
         x_axis = 'x'
         y_axis = 'z'
     elif axis == 'z':
-        coord = dict(z=pos)
         x_axis = 'x'
         y_axis = 'y'
     else:
         raise ValueError('plane must be x, y, or z')
 
+    if defer_full_res is None:
+        defer_full_res = widget['slice_defer_full_res']
+
     fig = widget['fig'][axis]
     ax = fig.axes[0]
 
+    level = _select_pyramid_level(img_data=img_data, fig=fig, x_axis=x_axis,
+                                  y_axis=y_axis)
+    _cancel_full_res(widget=widget, axis=axis)
+    if defer_full_res and level < len(img_data['levels']) - 1:
+        _schedule_full_res(widget=widget, state=state, axis=axis, pos=pos,
+                           img_data=img_data)
+        level += 1
+
+    volume = img_data['levels'][level]
+    idx = _get_slice_idx(img_data=volume, axis=axis, pos=pos)
+    slice_data = np.take(volume['data'], idx, axis='xyz'.index(axis))
+    # Rows of the image run along the y axis of the plot.
+    slice_data = slice_data.T
+    # The extent of the levels may differ slightly if a dimension is odd.
+    extent = _get_slice_extent(img_data=volume, x_axis=x_axis, y_axis=y_axis)
+
     assert len(ax.images) <= 1
     if ax.images:
-        ax.images[0].remove()
-
-    kwargs = dict(x=x_axis, y=y_axis,
-                  cmap='gray', vmin=0, vmax=127,
-                  add_colorbar=False, add_labels=False,
-                  ax=ax)
+        ax.images[0].set_data(slice_data)
+        ax.images[0].set_extent(extent)
+    else:
+        ax.imshow(slice_data, cmap='gray', vmin=0, vmax=127, origin='lower',
+                  extent=extent, interpolation='nearest')
+        ax.set_axis_off()
+        ax.set_aspect('equal')
+        ax.format_coord = _create_format_coord(axis)
 
-    xr.plot.imshow(img_data.sel(**coord, method='nearest'), **kwargs)
-    ax.set_axis_off()
-    ax.set_aspect('equal')
-    ax.format_coord = _create_format_coord(axis)
     # draw_crosshairs(widget=widget, state=state)
-    fig.canvas.draw()
+    # The cached background for blitting is outdated now.
+    widget['slice_background'][axis] = None
+    fig.canvas.draw_idle()
 
     label_text = state['label_text']
     label_text['x'] = (f'sagittal '
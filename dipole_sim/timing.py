@@ -0,0 +1,27 @@
+import time
+from contextlib import contextmanager
+
+
+# app.py imports this module first, so we can tell how long importing the
+# app took.
+IMPORT_START = time.perf_counter()
+
+
+@contextmanager
+def timed(times, name):
+    """Add the time spent in the with block to times[name], in seconds.
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        times[name] = times.get(name, 0.) + time.perf_counter() - start
+
+
+def format_timing_report(times, title='Startup times'):
+    width = max(len(name) for name in [*times, 'total'])
+    lines = [f'{title}:']
+    for name, duration in times.items():
+        lines.append(f'    {name:<{width}} {duration * 1e3:8.1f} ms')
+    lines.append(f'    {"total":<{width}} {sum(times.values()) * 1e3:8.1f} ms')
+    return '\n'.join(lines)
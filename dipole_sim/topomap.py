@@ -0,0 +1,162 @@
+import warnings
+import numpy as np
+from scipy.interpolate import CloughTocher2DInterpolator
+from scipy.sparse import csr_matrix
+from matplotlib.ticker import MaxNLocator
+
+from mne.defaults import _handle_default
+from mne.viz.topomap import (_prepare_topomap_plot, _make_head_outlines,
+                             _check_extrapolate, _setup_interp, _get_patch,
+                             _draw_outlines)
+
+
+# Interpolation weights below this threshold are dropped from the operator.
+# The weights of each pixel sum to 1, so the resulting error is negligible.
+_WEIGHT_THRESHOLD = 1e-6
+
+
+def _get_extra_point_weights(tri, n_points, n_extra):
+    # MNE sets the value of each extra (extrapolation) point to the mean of
+    # its neighboring sensors; express this as a linear operator.
+    indices, indptr = tri.vertex_neighbor_vertices
+    weights = np.zeros((n_extra, n_points))
+    for idx in range(n_extra):
+        extra_idx = n_points + idx
+        ngb = indptr[indices[extra_idx]:indices[extra_idx + 1]]
+        ngb = ngb[ngb < n_points]
+        if len(ngb) > 0:
+            weights[idx, ngb] = 1 / len(ngb)
+
+    used = weights.any(axis=1)
+    if not used.all() and used.any():
+        weights[~used] = weights[used].mean(axis=0)
+
+    return weights
+
+
+def create_topomap_renderer(info, ch_type, outlines, res=64, contours=6):
+    """Pre-compute everything needed to render topomaps of one channel type.
+
+    This mirrors what ``mne.Evoked.plot_topomap()`` does internally, but
+    only once: the interpolation from sensor values onto the image pixel
+    grid is linear in the sensor values, so we evaluate it for each sensor
+    separately and store the result as a sparse matrix. Rendering a new
+    field then only requires a single sparse matrix-vector product.
+    """
+    picks, pos, merge_channels, _, _, sphere, clip_origin = \
+        _prepare_topomap_plot(info, ch_type)
+    outlines = _make_head_outlines(sphere, pos, outlines, clip_origin)
+    extrapolate = _check_extrapolate('auto', ch_type)
+    extent, Xi, Yi, interp = _setup_interp(pos, res, extrapolate, sphere,
+                                           outlines, border='mean')
+
+    n_points = len(pos)
+    extra_weights = _get_extra_point_weights(tri=interp.tri,
+                                             n_points=n_points,
+                                             n_extra=interp.n_extra)
+    basis = np.concatenate([np.eye(n_points), extra_weights])
+    weights = CloughTocher2DInterpolator(interp.tri, basis)(Xi, Yi)
+    weights = weights.reshape(-1, n_points)
+
+    # Pixels outside of the convex hull of all points cannot be interpolated.
+    outside = np.isnan(weights).any(axis=1)
+    weights[outside] = 0
+    weights[np.abs(weights) < _WEIGHT_THRESHOLD] = 0
+
+    renderer = dict(ch_type=ch_type,
+                    picks=picks,
+                    merge_channels=merge_channels,
+                    scaling=_handle_default('scalings')[ch_type],
+                    pos=pos,
+                    outlines=outlines,
+                    extrapolate=extrapolate,
+                    interp=interp,
+                    extent=extent,
+                    Xi=Xi,
+                    Yi=Yi,
+                    operator=csr_matrix(weights),
+                    outside=outside,
+                    n_contours=contours,
+                    image=None,
+                    contours=None)
+    return renderer
+
+
+def _interpolate(renderer, meeg_data):
+    data = meeg_data[renderer['picks']] * renderer['scaling']
+    if renderer['merge_channels']:
+        # RMS of the gradiometer pairs.
+        data = np.sqrt(np.sum(data.reshape(-1, 2) ** 2, axis=1) / 2)
+
+    zi = renderer['operator'] @ data
+    zi[renderer['outside']] = np.nan
+    zi = zi.reshape(renderer['Xi'].shape)
+    return data, zi
+
+
+def _draw_contours(renderer, ax, zi, vmin, vmax):
+    if renderer['contours'] is not None:
+        for collection in renderer['contours'].collections:
+            collection.remove()
+        renderer['contours'] = None
+
+    if ((zi == zi[0, 0]) | np.isnan(zi)).all():
+        return  # Can't draw contours for constant-valued functions.
+
+    levels = MaxNLocator(nbins=renderer['n_contours'] + 1).tick_values(vmin,
+                                                                        vmax)
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        contours = ax.contour(renderer['Xi'], renderer['Yi'], zi, levels,
+                              colors='k', linewidths=0.5)
+
+    clip_path = renderer['image'].get_clip_path()
+    if clip_path is not None:
+        for collection in contours.collections:
+            collection.set_clip_path(clip_path)
+
+    renderer['contours'] = contours
+
+
+def draw_topomap(renderer, ax, meeg_data):
+    """Draw a topomap from scratch into an empty axes.
+    """
+    data, zi = _interpolate(renderer=renderer, meeg_data=meeg_data)
+    vmax = np.abs(data).max()
+    vmin = 0. if renderer['merge_channels'] else -vmax
+    cmap = 'Reds' if vmin >= 0 else 'RdBu_r'
+
+    ax.set_xticks([])
+    ax.set_yticks([])
+    ax.set_frame_on(False)
+
+    patch = _get_patch(renderer['outlines'], renderer['extrapolate'],
+                       renderer['interp'], ax)
+    image = ax.imshow(zi, cmap=cmap, vmin=vmin, vmax=vmax, origin='lower',
+                      aspect='equal', extent=renderer['extent'],
+                      interpolation='bilinear')
+    if patch is not None:
+        image.set_clip_path(patch)
+    renderer['image'] = image
+    renderer['contours'] = None
+
+    _draw_contours(renderer=renderer, ax=ax, zi=zi, vmin=vmin, vmax=vmax)
+    pos_x, pos_y = renderer['pos'].T
+    ax.scatter(pos_x, pos_y, s=0.25, marker='o',
+               edgecolor=['k'] * len(pos_x), facecolor='none')
+    _draw_outlines(ax, renderer['outlines'])
+    return image
+
+
+def update_topomap(renderer, ax, meeg_data):
+    """Update the topomap previously drawn via draw_topomap() in place.
+    """
+    data, zi = _interpolate(renderer=renderer, meeg_data=meeg_data)
+    vmax = np.abs(data).max()
+    vmin = 0. if renderer['merge_channels'] else -vmax
+
+    image = renderer['image']
+    image.set_data(zi)
+    image.set_clim(vmin, vmax)
+    _draw_contours(renderer=renderer, ax=ax, zi=zi, vmin=vmin, vmax=vmax)
+    return image
@@ -1,33 +1,58 @@
 import numpy as np
-import nibabel as nib
-from mne.transforms import combine_transforms, invert_transform, Transform
+from mne.transforms import apply_trans, invert_transform
+
+from grid import create_grid
 
 
 def gen_ras_to_head_trans(head_to_mri_t, t1_img):
+    """Generate a single affine mapping MRI RAS coordinates (in mm) to MNE
+    Head coordinates (in m).
+    """
     # RAS -> VOXEL
-    ras_to_vox_t = Transform(fro='ras', to='mri_voxel',
-                             trans=np.linalg.inv(t1_img.header.get_vox2ras()))
+    ras_to_vox = np.linalg.inv(t1_img.header.get_vox2ras())
+
+    # VOXEL -> MRI (surface RAS, in mm)
+    vox_to_mri = t1_img.header.get_vox2ras_tkr()
 
-    # VOXEL -> MRI
-    vox_to_mri_t = Transform(fro='mri_voxel', to='mri',
-                             trans=t1_img.header.get_vox2ras_tkr())
+    # mm -> m
+    mm_to_m = np.diag([1e-3, 1e-3, 1e-3, 1.])
 
     # MRI -> HEAD
-    mri_to_head_t = invert_transform(head_to_mri_t)
-    
+    mri_to_head = invert_transform(head_to_mri_t)['trans']
+
     # Now we have generated all the required transformations
     # to go from RAS to MNE Head coordinates. Let's combine
-    # the transforms into a single transform. This requires
-    # two calls to `combine_transforms()`.
+    # them into a single affine.
+    ras_to_head = mri_to_head @ mm_to_m @ vox_to_mri @ ras_to_vox
+    return ras_to_head
+
+
+def gen_geometry_context(head_to_mri_t, t1_img, info, grid_steps=50):
+    """Pre-compute all coordinate transformations and the head grid.
+
+    None of these change during a session, so we generate them only once
+    and pass them around.
+    """
+    ras_to_head = gen_ras_to_head_trans(head_to_mri_t=head_to_mri_t,
+                                        t1_img=t1_img)
+    geometry = dict(ras_to_head=ras_to_head,
+                    head_to_ras=np.linalg.inv(ras_to_head),
+                    head_to_mri_t=head_to_mri_t,
+                    grid=create_grid(info=info, grid_steps=grid_steps))
+    return geometry
+
+
+def ras_to_head(geometry, pts, move=True):
+    """Transform points of shape (..., 3) from MRI RAS (mm) to MNE Head (m).
+
+    Pass move=False to transform directions instead of points.
+    """
+    return apply_trans(geometry['ras_to_head'], pts, move=move)
 
-    # RAS -> MRI
-    ras_to_mri_t = combine_transforms(ras_to_vox_t,
-                                      vox_to_mri_t,
-                                      fro='ras', to='mri')
 
-    # RAS -> HEAD
-    ras_to_head_t = combine_transforms(ras_to_mri_t,
-                                       mri_to_head_t,
-                                       fro='ras', to='head')
+def head_to_ras(geometry, pts, move=True):
+    """Transform points of shape (..., 3) from MNE Head (m) to MRI RAS (mm).
 
-    return ras_to_head_t
+    Pass move=False to transform directions instead of points.
+    """
+    return apply_trans(geometry['head_to_ras'], pts, move=move)
@@ -0,0 +1,53 @@
+import numpy as np
+
+
+def damped_sinusoid(times, freq=10., tau=0.1, amplitude=1., phase=0.,
+                    onset=0.):
+    """A sinusoid that starts at onset and decays exponentially.
+
+    times, onset, and the time constant tau are in seconds, freq is in Hz,
+    and the amplitude (the envelope at onset) is in Am. The waveform is zero
+    before onset.
+    """
+    t = np.asarray(times, dtype=np.float64) - onset
+    waveform = (amplitude * np.exp(-np.maximum(t, 0) / tau) *
+                np.sin(2 * np.pi * freq * t + phase))
+    waveform[t < 0] = 0
+    return waveform
+
+
+def get_n_times(waveform, times=None):
+    """The number of samples of a waveform, see get_waveform_block().
+
+    Raises ValueError if times don't match the samples of a waveform array.
+    """
+    if callable(waveform):
+        if times is None:
+            raise ValueError('Must provide times if waveform is a function')
+        return len(times)
+
+    n_times = np.shape(waveform)[-1]
+    if times is not None and len(times) != n_times:
+        raise ValueError(f'The waveform has {n_times} samples, but '
+                         f'{len(times)} times were provided')
+    return n_times
+
+
+def get_waveform_block(waveform, times, start, stop, n_dipoles):
+    """Evaluate the time courses of all dipoles for times[start:stop].
+
+    waveform is an array of shape (n_times,), shared by all dipoles, or
+    (n_dipoles, n_times); or a function mapping times to such an array, e.g.
+    functools.partial(damped_sinusoid, freq=20.). Arrays may be
+    memory-mapped, only the requested block is read.
+
+    Returns an array of shape (n_dipoles, stop - start).
+    """
+    get_n_times(waveform=waveform, times=times)  # Check the times.
+    if callable(waveform):
+        block = waveform(times[start:stop])
+    else:
+        block = np.asarray(waveform)[..., start:stop]
+
+    block = np.asarray(block, dtype=np.float64)
+    return np.broadcast_to(np.atleast_2d(block), (n_dipoles, stop - start))
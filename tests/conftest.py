@@ -0,0 +1,119 @@
+import pathlib
+import shutil
+import sys
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+import pytest
+
+# The modules of the app are imported by their bare names.
+sys.path.insert(0, str(pathlib.Path(__file__).parents[1] / 'dipole_sim'))
+
+data_path = pathlib.Path(__file__).parents[1] / 'data'
+
+
+@pytest.fixture(scope='session')
+def info():
+    import mne
+
+    info = mne.io.read_info(data_path / 'sample-ave.fif', verbose=False)
+    info = mne.pick_info(info, mne.pick_types(info, meg=True, eeg=True))
+    with info._unlock():
+        info['projs'] = []
+        info['bads'] = []
+    return info
+
+
+@pytest.fixture(scope='session')
+def trans():
+    import mne
+
+    return mne.read_trans(data_path / 'sample-trans.fif')
+
+
+@pytest.fixture(scope='session')
+def t1_img():
+    # A stand-in for the sample subject's T1.mgz, which isn't shipped.
+    import nibabel as nib
+
+    affine = np.array([[-1., 0, 0, 128], [0, 0, 1, -128], [0, -1, 0, 128],
+                       [0, 0, 0, 1]])
+    rng = np.random.default_rng(0)
+    data = rng.integers(0, 128, size=(256, 256, 256), dtype=np.uint8)
+    return nib.MGHImage(data, affine)
+
+
+@pytest.fixture(scope='session')
+def sim_data_path(tmp_path_factory, info, trans, t1_img):
+    """A data directory with a leadfield store of random leadfields.
+    """
+    from simulator import Simulator
+    from leadfield import write_leadfield_store
+    from grid import get_grid_node_pos
+
+    path = tmp_path_factory.mktemp('data')
+    (path / 'fwd').mkdir()
+    (path / 'subjects' / 'sample' / 'mri').mkdir(parents=True)
+    shutil.copy(data_path / 'fwd' / 'fwd_lookup_table.npz', path / 'fwd')
+
+    simulator = Simulator(info=info, trans=trans, t1_img=t1_img,
+                          data_path=path)
+    ijk = np.argwhere(simulator._fwd_index >= 0)
+    simulator.shutdown()
+
+    pos = get_grid_node_pos(simulator.geometry['grid'], ijk)
+    rng = np.random.default_rng(0)
+    leadfield = rng.standard_normal((len(pos), len(info['ch_names']), 3))
+    write_leadfield_store(path / 'fwd', 'sample', pos,
+                          (leadfield * 1e-8).astype(np.float32),
+                          info['ch_names'])
+    return path
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'  # Keep connections alive, like GitHub.
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        server = self.server
+        with server.lock:
+            server.requests.append(self.path)
+        route = server.routes.get(self.path, server.default_route)
+        if route is None:
+            self.send_error(404)
+        else:
+            route(self)
+
+    def send_content(self, content, status=200):
+        self.send_response(status)
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def http_server():
+    """A local stand-in for the file server, running in a thread.
+
+    Set routes[path] (or default_route) to a function taking the request
+    handler, e.g. lambda handler: handler.send_content(b'...'); requests
+    lists the paths requested so far.
+    """
+    server = ThreadingHTTPServer(('127.0.0.1', 0), _Handler)
+    server.daemon_threads = True
+    server.lock = threading.Lock()
+    server.requests = []
+    server.routes = dict()
+    server.default_route = None
+    server.url = f'http://127.0.0.1:{server.server_address[1]}'
+
+    thread = threading.Thread(target=server.serve_forever,
+                              kwargs=dict(poll_interval=0.05), daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
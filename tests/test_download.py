@@ -0,0 +1,130 @@
+import hashlib
+import os
+
+import pytest
+
+from download import download_file, download_fwd_from_github
+
+CONTENT = os.urandom(100_000)
+CHECKSUM = f'md5:{hashlib.md5(CONTENT).hexdigest()}'
+
+
+def _download(http_server, fname, **kwargs):
+    kwargs.setdefault('backoff', 0)
+    download_file(url=f'{http_server.url}/file', fname=fname, **kwargs)
+
+
+def _assert_no_tmp_files(path):
+    assert not [p for p in path.iterdir() if p.name.endswith('.tmp')]
+
+
+def test_download(http_server, tmp_path):
+    http_server.routes['/file'] = lambda handler: handler.send_content(
+        CONTENT)
+    _download(http_server, tmp_path / 'file', checksum=CHECKSUM,
+              chunk_size=4096)
+    assert (tmp_path / 'file').read_bytes() == CONTENT
+    _assert_no_tmp_files(tmp_path)
+
+
+def test_download_chunked(http_server, tmp_path):
+    # Without a Content-Length, the response is streamed until it ends.
+    def send_chunked(handler):
+        handler.send_response(200)
+        handler.send_header('Transfer-Encoding', 'chunked')
+        handler.end_headers()
+        for start in range(0, len(CONTENT), 30_000):
+            chunk = CONTENT[start:start + 30_000]
+            handler.wfile.write(b'%x\r\n%s\r\n' % (len(chunk), chunk))
+        handler.wfile.write(b'0\r\n\r\n')
+
+    http_server.routes['/file'] = send_chunked
+    _download(http_server, tmp_path / 'file', checksum=CHECKSUM)
+    assert (tmp_path / 'file').read_bytes() == CONTENT
+
+
+def test_transient_errors_are_retried(http_server, tmp_path):
+    def flaky(handler):
+        if len(http_server.requests) < 3:
+            handler.send_error(503)
+        else:
+            handler.send_content(CONTENT)
+
+    http_server.routes['/file'] = flaky
+    _download(http_server, tmp_path / 'file', retries=3)
+    assert (tmp_path / 'file').read_bytes() == CONTENT
+    assert len(http_server.requests) == 3
+
+
+def test_retries_are_limited(http_server, tmp_path):
+    http_server.routes['/file'] = lambda handler: handler.send_error(503)
+    with pytest.raises(RuntimeError, match='after 3 attempts'):
+        _download(http_server, tmp_path / 'file', retries=2)
+    assert len(http_server.requests) == 3
+    assert not (tmp_path / 'file').exists()
+    _assert_no_tmp_files(tmp_path)
+
+
+def test_missing_file_is_not_retried(http_server, tmp_path):
+    with pytest.raises(RuntimeError, match='status 404'):
+        _download(http_server, tmp_path / 'file')
+    assert len(http_server.requests) == 1
+    assert not (tmp_path / 'file').exists()
+
+
+def test_truncated_transfer(http_server, tmp_path):
+    def truncated(handler):
+        # Announce all of the content, but hang up halfway through.
+        handler.send_response(200)
+        handler.send_header('Content-Length', str(len(CONTENT)))
+        handler.end_headers()
+        handler.wfile.write(CONTENT[:len(CONTENT) // 2])
+        handler.close_connection = True
+
+    http_server.routes['/file'] = truncated
+    with pytest.raises(RuntimeError, match='after 2 attempts'):
+        _download(http_server, tmp_path / 'file', retries=1)
+    assert len(http_server.requests) == 2
+    assert not (tmp_path / 'file').exists()
+    _assert_no_tmp_files(tmp_path)
+
+    # A complete transfer on the next attempt succeeds.
+    def truncated_once(handler):
+        if len(http_server.requests) == 3:
+            truncated(handler)
+        else:
+            handler.send_content(CONTENT)
+
+    http_server.routes['/file'] = truncated_once
+    _download(http_server, tmp_path / 'file', retries=1)
+    assert (tmp_path / 'file').read_bytes() == CONTENT
+
+
+def test_checksum_mismatch(http_server, tmp_path):
+    http_server.routes['/file'] = lambda handler: handler.send_content(
+        CONTENT[::-1])
+    with pytest.raises(RuntimeError, match='Checksum mismatch'):
+        _download(http_server, tmp_path / 'file', checksum=CHECKSUM,
+                  retries=1)
+    assert len(http_server.requests) == 2
+    assert not (tmp_path / 'file').exists()
+    _assert_no_tmp_files(tmp_path)
+
+    with pytest.raises(ValueError, match='Invalid checksum'):
+        _download(http_server, tmp_path / 'file', checksum='foo:123')
+
+
+def test_download_fwd_from_github(http_server, tmp_path):
+    fname = 'sample-0.010--0.020-0.030-fwd.fif'
+    http_server.routes[f'/fwd/{fname}'] = lambda handler: (
+        handler.send_content(CONTENT))
+    download_fwd_from_github(fwd_path=tmp_path, subject='sample',
+                             dipole_pos=(0.01, -0.02, 0.03),
+                             base_url=http_server.url)
+    assert (tmp_path / fname).read_bytes() == CONTENT
+
+    # Existing files aren't downloaded again.
+    download_fwd_from_github(fwd_path=tmp_path, subject='sample',
+                             dipole_pos=(0.01, -0.02, 0.03),
+                             base_url=http_server.url)
+    assert len(http_server.requests) == 1
@@ -0,0 +1,52 @@
+import os
+
+import numpy as np
+import nibabel as nib
+
+from mri import load_mr_volume, create_mr_pyramid
+
+
+def _write_image(fname, value):
+    data = np.full((8, 8, 8), value, dtype=np.uint8)
+    nib.save(nib.MGHImage(data, np.eye(4)), str(fname))
+    return nib.load(str(fname))
+
+
+def test_cached_volume(tmp_path):
+    cache_fname = tmp_path / 'T1-canonical.npy'
+    img = _write_image(tmp_path / 'T1.mgz', 1)
+
+    volume = load_mr_volume(img, cache_fname=cache_fname)
+    assert not isinstance(volume['data'], np.memmap)
+    cached = load_mr_volume(img, cache_fname=cache_fname)
+    assert isinstance(cached['data'], np.memmap)
+    np.testing.assert_array_equal(cached['data'], volume['data'])
+    np.testing.assert_allclose(cached['affine'], volume['affine'])
+    assert sorted(p.name for p in tmp_path.iterdir()) == [
+        'T1-canonical.json', 'T1-canonical.npy', 'T1.mgz']
+
+    # A new image of the same shape and affine isn't served from the
+    # cache, and rewriting the cache leaves existing memory maps intact.
+    img = _write_image(tmp_path / 'T1.mgz', 2)
+    stat = os.stat(tmp_path / 'T1.mgz')
+    os.utime(tmp_path / 'T1.mgz',
+             ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+    volume = load_mr_volume(img, cache_fname=cache_fname)
+    assert (volume['data'] == 2).all()
+    assert (cached['data'] == 1).all()
+    assert (load_mr_volume(img, cache_fname=cache_fname)['data'] == 2).all()
+
+
+def test_mr_pyramid():
+    rng = np.random.default_rng(0)
+    data = rng.integers(0, 256, size=(16, 16, 16), dtype=np.uint8)
+    volume = load_mr_volume(nib.MGHImage(data, np.eye(4)))
+    pyramid = create_mr_pyramid(volume, n_levels=3)
+
+    level = pyramid['levels'][1]
+    expected = data.reshape(8, 2, 8, 2, 8, 2).mean(axis=(1, 3, 5))
+    assert level['data'].dtype == np.uint8
+    assert np.abs(level['data'] - expected).max() <= 0.5
+    # Voxel centers lie between those of the finer level.
+    np.testing.assert_allclose(level['coords']['x'], np.arange(8) * 2 + 0.5)
+    assert pyramid['levels'][2]['data'].shape == (4, 4, 4)
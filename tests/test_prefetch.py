@@ -0,0 +1,113 @@
+import threading
+import time
+
+import numpy as np
+import pytest
+
+from prefetch import FwdPrefetcher
+from grid import get_grid_node_pos
+
+GRID = dict(origin=np.zeros(3), spacing=np.full(3, 0.01), shape=(10, 10, 10))
+
+
+def _get_path(ijk):
+    x, y, z = get_grid_node_pos(GRID, ijk)
+    return f'/fwd/sample-{x:.3f}-{y:.3f}-{z:.3f}-fwd.fif'
+
+
+def _wait_for(condition, timeout=10):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, 'Timed out'
+        time.sleep(0.01)
+
+
+@pytest.fixture
+def gated_server(http_server):
+    """Serve forward solutions only once the gate is opened.
+    """
+    http_server.gate = threading.Event()
+
+    def send_fwd(handler):
+        http_server.gate.wait()
+        handler.send_content(b'fwd')
+
+    http_server.default_route = send_fwd
+    return http_server
+
+
+@pytest.fixture
+def prefetcher(gated_server, tmp_path):
+    # A single worker, so we know which downloads are still queued.
+    prefetcher = FwdPrefetcher(fwd_path=tmp_path, subject='sample', grid=GRID,
+                               fwd_index=np.arange(1000).reshape(10, 10, 10),
+                               radius=1, max_workers=1,
+                               base_url=gated_server.url)
+    yield prefetcher
+    gated_server.gate.set()
+    prefetcher.shutdown()
+
+
+def test_prefetch_is_cancelled(gated_server, prefetcher, tmp_path):
+    prefetcher.prefetch_around((2, 2, 2))
+    _wait_for(lambda: len(gated_server.requests) == 1)
+    first = gated_server.requests[0]
+
+    # Moving the dipole cancels the queued downloads of the old neighbors,
+    # but not the one in progress.
+    prefetcher.prefetch_around((7, 7, 7))
+    gated_server.gate.set()
+    _wait_for(lambda: not prefetcher._pending)
+
+    neighbors = [(7 + i, 7 + j, 7 + k)
+                 for i in (-1, 0, 1) for j in (-1, 0, 1) for k in (-1, 0, 1)
+                 if (i, j, k) != (0, 0, 0)]
+    assert sorted(gated_server.requests) == sorted(
+        [first] + [_get_path(ijk) for ijk in neighbors])
+    assert len(list(tmp_path.iterdir())) == 27
+
+
+def test_fetch_waits_for_prefetch(gated_server, prefetcher, tmp_path):
+    prefetcher.prefetch_around((5, 5, 5))
+    _wait_for(lambda: len(gated_server.requests) == 1)
+    in_progress = gated_server.requests[0]
+    ijk = next(node for node in prefetcher._pending
+               if _get_path(node) == in_progress)
+
+    # Fetching the node being prefetched doesn't download it again.
+    thread = threading.Thread(target=prefetcher.fetch, args=(ijk,))
+    thread.start()
+    time.sleep(0.1)
+    assert thread.is_alive()
+    gated_server.gate.set()
+    thread.join()
+    assert (tmp_path / in_progress.split('/')[-1]).exists()
+    _wait_for(lambda: not prefetcher._pending)
+    assert gated_server.requests.count(in_progress) == 1
+
+
+def test_fetch_takes_over_queued_prefetch(gated_server, prefetcher):
+    prefetcher.prefetch_around((5, 5, 5))
+    _wait_for(lambda: len(gated_server.requests) == 1)
+
+    # A node that is still queued is downloaded right away, instead of
+    # waiting for its turn.
+    ijk = (6, 6, 6)
+    thread = threading.Thread(target=prefetcher.fetch, args=(ijk,))
+    thread.start()
+    _wait_for(lambda: _get_path(ijk) in gated_server.requests)
+    assert len(gated_server.requests) == 2
+    gated_server.gate.set()
+    thread.join()
+    _wait_for(lambda: not prefetcher._pending)
+    assert gated_server.requests.count(_get_path(ijk)) == 1
+
+
+def test_fetch_raises(http_server, tmp_path):
+    # Nothing is served, so all downloads fail.
+    prefetcher = FwdPrefetcher(fwd_path=tmp_path, subject='sample', grid=GRID,
+                               fwd_index=np.arange(1000).reshape(10, 10, 10),
+                               radius=0, base_url=http_server.url)
+    with pytest.raises(RuntimeError, match='status 404'):
+        prefetcher.fetch((5, 5, 5))
+    prefetcher.shutdown()
@@ -0,0 +1,133 @@
+import socket
+import threading
+from multiprocessing import AuthenticationError
+
+import numpy as np
+import pytest
+
+from server import start_server_process, SimulatorClient
+from simulator import Simulator
+
+AUTHKEY = b'test'
+
+# A dipole inside the brain, and one far outside of the head (MRI RAS, mm).
+POS_INSIDE = [2.94, -76.54, -0.38]
+POS_OUTSIDE = [0., 0., 500.]
+ORI = [1., 1., 1.]
+
+
+def _get_free_address():
+    with socket.socket() as sock:
+        sock.bind(('localhost', 0))
+        return sock.getsockname()
+
+
+@pytest.fixture(scope='module')
+def server_address(info, trans, t1_img, sim_data_path):
+    address = _get_free_address()
+    process = start_server_process(info=info, trans=trans, t1_img=t1_img,
+                                   authkey=AUTHKEY, address=address,
+                                   data_path=sim_data_path)
+    yield address
+    process.terminate()
+    process.join()
+
+
+@pytest.fixture(scope='module')
+def local_simulator(info, trans, t1_img, sim_data_path):
+    simulator = Simulator(info=info, trans=trans, t1_img=t1_img,
+                          data_path=sim_data_path)
+    yield simulator
+    simulator.shutdown()
+
+
+def test_server_matches_local_simulator(server_address, local_simulator):
+    client = SimulatorClient(authkey=AUTHKEY, address=server_address)
+    try:
+        np.testing.assert_allclose(
+            client.compute_field(POS_INSIDE, ORI, amplitude=5e-8),
+            local_simulator.compute_field(POS_INSIDE, ORI, amplitude=5e-8))
+        assert client.compute_field(POS_OUTSIDE, ORI) is None
+
+        rng = np.random.default_rng(0)
+        pos = rng.normal(scale=30, size=(20, 3))
+        ori = rng.normal(size=(20, 3))
+        np.testing.assert_allclose(client.compute_fields(pos, ori),
+                                   local_simulator.compute_fields(pos, ori))
+    finally:
+        client.close()
+
+
+def test_interpolation_is_kept_per_client(server_address, local_simulator):
+    nearest = SimulatorClient(authkey=AUTHKEY, address=server_address)
+    trilinear = SimulatorClient(authkey=AUTHKEY, address=server_address,
+                                interpolation='trilinear')
+    try:
+        np.testing.assert_allclose(
+            trilinear.compute_field(POS_INSIDE, ORI),
+            local_simulator.compute_field(POS_INSIDE, ORI,
+                                          interpolation='trilinear'))
+        np.testing.assert_allclose(
+            nearest.compute_field(POS_INSIDE, ORI),
+            local_simulator.compute_field(POS_INSIDE, ORI))
+    finally:
+        nearest.close()
+        trilinear.close()
+
+
+def test_concurrent_requests(server_address, local_simulator):
+    expected = local_simulator.compute_field(POS_INSIDE, ORI)
+    clients = [SimulatorClient(authkey=AUTHKEY, address=server_address)
+               for _ in range(2)]
+    results = []
+
+    def run(client):
+        for _ in range(20):
+            results.append(client.compute_field(POS_INSIDE, ORI))
+
+    # Two threads share the first client, which must serialize them.
+    threads = [threading.Thread(target=run, args=(client,))
+               for client in clients + clients[:1]]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    for client in clients:
+        client.close()
+
+    assert len(results) == 60
+    for result in results:
+        np.testing.assert_allclose(result, expected)
+
+
+def test_time_course(server_address, local_simulator):
+    client = SimulatorClient(authkey=AUTHKEY, address=server_address)
+    try:
+        waveform = np.linspace(0, 1e-8, 10)
+        np.testing.assert_allclose(
+            client.compute_time_course(POS_INSIDE, ORI, waveform),
+            local_simulator.compute_time_course(POS_INSIDE, ORI, waveform))
+    finally:
+        client.close()
+
+
+def test_unknown_method(server_address):
+    client = SimulatorClient(authkey=AUTHKEY, address=server_address)
+    try:
+        with pytest.raises(RuntimeError, match='Unknown method'):
+            client._request('shutdown')
+        # The connection remains usable.
+        assert client.compute_field(POS_INSIDE, ORI) is not None
+    finally:
+        client.close()
+
+
+def test_wrong_authkey(server_address):
+    with pytest.raises(AuthenticationError):
+        SimulatorClient(authkey=b'wrong', address=server_address)
+
+
+def test_time_course_checks_times(local_simulator):
+    with pytest.raises(ValueError, match='10 samples, but 9 times'):
+        local_simulator.iter_time_course(POS_INSIDE, ORI, np.zeros(10),
+                                         times=np.zeros(9))
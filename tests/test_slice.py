@@ -0,0 +1,24 @@
+import matplotlib
+import matplotlib.pyplot as plt
+import numpy as np
+import nibabel as nib
+
+from mri import load_mr_volume, create_mr_pyramid
+from slice import _select_pyramid_level
+
+matplotlib.use('agg')
+
+
+def test_select_pyramid_level():
+    data = np.zeros((256, 256, 256), dtype=np.uint8)
+    pyramid = create_mr_pyramid(load_mr_volume(nib.MGHImage(data, np.eye(4))),
+                                n_levels=3)
+
+    # The size of the slice figures of the App.
+    fig, _ = plt.subplots(1, figsize=(2, 2), dpi=100)
+    assert _select_pyramid_level(pyramid, fig, 'x', 'y') == 1
+    fig.set_dpi(50)
+    assert _select_pyramid_level(pyramid, fig, 'x', 'y') == 2
+    fig.set_dpi(200)
+    assert _select_pyramid_level(pyramid, fig, 'x', 'y') == 0
+    plt.close('all')
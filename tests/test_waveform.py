@@ -0,0 +1,37 @@
+import functools
+
+import numpy as np
+import pytest
+
+from waveform import damped_sinusoid, get_n_times, get_waveform_block
+
+
+def test_waveform_block():
+    times = np.arange(100) / 1000
+    waveform = np.arange(200.).reshape(2, 100)
+    assert get_n_times(waveform) == get_n_times(waveform, times) == 100
+    block = get_waveform_block(waveform, times, start=10, stop=20,
+                               n_dipoles=2)
+    np.testing.assert_array_equal(block, waveform[:, 10:20])
+
+    # A single waveform is shared by all dipoles.
+    block = get_waveform_block(waveform[0], None, start=10, stop=20,
+                               n_dipoles=3)
+    assert block.shape == (3, 10)
+
+    function = functools.partial(damped_sinusoid, freq=20.)
+    assert get_n_times(function, times) == 100
+    block = get_waveform_block(function, times, start=10, stop=20,
+                               n_dipoles=1)
+    np.testing.assert_allclose(block[0], function(times[10:20]))
+
+
+def test_waveform_times_mismatch():
+    times = np.arange(99) / 1000
+    waveform = np.zeros((2, 100))
+    with pytest.raises(ValueError, match='100 samples, but 99 times'):
+        get_n_times(waveform, times)
+    with pytest.raises(ValueError, match='100 samples, but 99 times'):
+        get_waveform_block(waveform, times, start=0, stop=10, n_dipoles=2)
+    with pytest.raises(ValueError, match='Must provide times'):
+        get_n_times(damped_sinusoid)